@@ -2,7 +2,22 @@ import os
 import sys
 import time
 import ctypes
+import array
 import string
+import pickle
+import marshal
+import inspect
+import hashlib
+import heapq
+import bisect
+import asyncio
+import weakref
+import threading
+import contextlib
+import itertools
+import collections
+import collections.abc
+import multiprocessing
 import traceback
 
 class FuncPtrWrapper():
@@ -14,24 +29,50 @@ class FuncPtrWrapper():
     def __call__(self, *args):
         raise ValueError("Function not declared")
 
-    def decl(self, rt, ats):
-        getattr(self.lib.lib, self.name).restype = rt
-        getattr(self.lib.lib, self.name).argtypes = tuple(ats)
+    def decl(self, rt, ats, release_gil=False):
+        for lib in (self.lib.lib, self.lib.pylib):
+            getattr(lib, self.name).restype = rt
+            getattr(lib, self.name).argtypes = tuple(ats)
         self.lib.decld_fptrs.add(self.name)
+        if release_gil:
+            self.lib.releasing_fptrs.add(self.name)
+        self.lib.__dict__.pop(self.name, None)
 
 class Lib():
+    # Functions are called through a PyDLL handle that keeps the GIL, which is much cheaper for the
+    # tiny stack functions. Only those declared with release_gil=True (lua_resume, lua_pcallk, ...)
+    # go through the CDLL handle and let other threads run. gil_mode="release" restores the old
+    # behaviour of releasing the GIL on every call
     
-    def __init__(self, path):
+    def __init__(self, path, gil_mode="auto"):
         if os.name == "nt":
             self.lib = ctypes.windll.LoadLibrary(path)
         else:
             self.lib = ctypes.CDLL(path)
+        self.pylib = ctypes.PyDLL(path)
         self.decld_fptrs = set()
+        self.releasing_fptrs = set()
+        self.gil_mode = gil_mode
     
+    def set_gil_mode(self, gil_mode):
+        if gil_mode not in ("auto", "release"):
+            raise ValueError("Unknown GIL mode %r" % gil_mode)
+        self.gil_mode = gil_mode
+        for name in self.decld_fptrs:
+            self.__dict__.pop(name, None)
+
     def __getattr__(self, name):
+        if name in ("lib", "pylib", "decld_fptrs"):
+            raise AttributeError(name)
         if hasattr(self.lib, name):
             if name in self.decld_fptrs:
-                return getattr(self.lib, name)
+                if self.gil_mode == "release" or name in self.releasing_fptrs:
+                    f = getattr(self.lib, name)
+                else:
+                    f = getattr(self.pylib, name)
+                # Cache on the instance so later lookups skip __getattr__
+                self.__dict__[name] = f
+                return f
             return FuncPtrWrapper(self, name)
         raise AttributeError(name)
 
@@ -41,18 +82,33 @@ class Lib():
 class LuaRuntimeError(RuntimeError):
     pass
 
+class LuaCommandError(Exception):
+    # Raised by an async command to make the command call raise an error on the Lua side instead of
+    # aborting the whole coroutine
+    pass
+
+class Proxy():
+    # Passes obj to Lua as a userdata that reads from the live object on access instead of a copy.
+    # Mappings and sequences (1-based from Lua) are indexed, anything else exposes its attributes,
+    # except those starting with an underscore
+
+    def __init__(self, obj):
+        self.obj = obj
+
 class _LuaReferenceContainer():
 
-    def __init__(self, thread):
+    def __init__(self, thread, idx=-1):
+        # References the value at idx without otherwise changing the stack
         self.thread = thread
+        lua54.lua_pushvalue(self.thread.L, idx)
         self.ref = lua54.luaL_ref(self.thread.L, lua54.LUA_REGISTRYINDEX)
-        # lua54.lua_pushnil(self.thread.L)
-        self._pushrefval()
+        self.thread.runtime.live_references += 1
 
     def __del__(self):
-        lua54.luaL_unref(self.thread.L, lua54.LUA_REGISTRYINDEX, self.ref)
+        self.thread.runtime._release_ref(self.ref)
 
     def _pushrefval(self):
+        self.thread.runtime._check_thread()
         lua54.lua_rawgeti(self.thread.L, lua54.LUA_REGISTRYINDEX, self.ref)
 
 class Function(_LuaReferenceContainer):
@@ -71,13 +127,68 @@ class Function(_LuaReferenceContainer):
         lua54.lua_pop(self.thread.L, 1)
         return r
 
-    async def __call__(self, *args):
-        coro = Coroutine(self.thread.runtime, args)
+    async def __call__(self, *args, string_type=None, timeout=None):
+        if timeout is not None:
+            return await asyncio.wait_for(self(*args, string_type=string_type), timeout)
+
+        coro = Coroutine(self.thread.runtime, args, string_type=string_type)
+        self.thread.runtime.owner_loop = asyncio.get_running_loop()
         self._pushrefval()
         lua54.lua_xmove(self.thread.L, coro.L, 1)
-        async for _ in coro:
-            pass
-        return coro.return_value
+        try:
+            async for _ in coro:
+                pass
+        except BaseException:
+            # Cancelled (the awaited command is cancelled with us) or failed, don't wait for the GC
+            # to give the thread back
+            coro.close()
+            raise
+        # Tables in the return value point back at coro; break the cycle so its thread can go back to
+        # the pool as soon as they're gone
+        return_value, coro.return_value = coro.return_value, None
+        return return_value
+
+    def stream(self, *args, string_type=None):
+        # Iterates over the values the function passes to emit(), resuming it only when the next one
+        # is asked for. A single value is returned as is, several as a tuple
+        coro = Coroutine(self.thread.runtime, args, string_type=string_type)
+        self._pushrefval()
+        lua54.lua_xmove(self.thread.L, coro.L, 1)
+        return _Stream(coro)
+
+class _Stream():
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.return_value = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.coro is None:
+            raise StopAsyncIteration
+        self.coro.runtime.owner_loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await self.coro.__anext__()
+                if self.coro.emitted is not None:
+                    values, self.coro.emitted = self.coro.emitted, None
+                    return values[0] if len(values) == 1 else values
+        except StopAsyncIteration:
+            self.return_value, self.coro.return_value = self.coro.return_value, None
+            self.coro = None
+            raise
+        except BaseException:
+            self.coro.close()
+            self.coro = None
+            raise
+
+    async def aclose(self):
+        # Abandons the function, its thread goes back to the pool
+        if self.coro is not None:
+            self.coro.close()
+            self.coro = None
 
 class Table(_LuaReferenceContainer):
     
@@ -98,25 +209,83 @@ class Table(_LuaReferenceContainer):
             raise NotImplementedError("_set_owner() on table returned by lua")
 
     @classmethod
-    def new(cls, runtime):
+    def new(cls, runtime, narr=0, nrec=0):
+        runtime._check_thread()
+        lua54.lua_createtable(runtime.L, narr, nrec)
+        return cls._from_runtime_stack(runtime)
+
+    @classmethod
+    def _from_runtime_stack(cls, runtime):
+        # Wraps (and pops) the table on top of the runtime's main stack
         self = cls.__new__(cls)
         self.thread = None
         self._runtime = runtime
-        
-        lua54.lua_createtable(self._runtime.L, 0, 0)
         self.ref = lua54.luaL_ref(self._runtime.L, lua54.LUA_REGISTRYINDEX)
-        
+        runtime.live_references += 1
         return self
+
+    @classmethod
+    def from_python(cls, runtime, obj):
+        # Converts a whole structure of dicts/lists/tuples in one go; shared and recursive containers
+        # become shared and recursive tables
+        runtime._check_thread()
+        L = runtime.L
+        lua54.lua_createtable(L, 0, 0)
+        memo_idx = lua54.lua_gettop(L)
+        memo = {}
+
+        def convert(obj):
+            if id(obj) in memo:
+                lua54.lua_rawgeti(L, memo_idx, memo[id(obj)])
+                return
+            # Not luaL_checkstack, its error would be raised outside of a protected call
+            if not lua54.lua_checkstack(L, 3):
+                raise RecursionError("Structure nested too deeply for the Lua stack")
+
+            if isinstance(obj, dict):
+                lua54.lua_createtable(L, 0, len(obj))
+            elif isinstance(obj, (list, tuple)):
+                lua54.lua_createtable(L, len(obj), 0)
+            else:
+                Coroutine._push_python_object(runtime, obj)
+                return
+
+            memo[id(obj)] = len(memo) + 1
+            lua54.lua_pushvalue(L, -1)
+            lua54.lua_rawseti(L, memo_idx, len(memo))
+            if isinstance(obj, dict):
+                for k, v in obj.items():
+                    # Would make lua_rawset raise outside of a protected call, which aborts
+                    if k is None or (isinstance(k, float) and k != k):
+                        raise ValueError("Table keys can't be None or NaN")
+                    convert(k)
+                    convert(v)
+                    lua54.lua_rawset(L, -3)
+            else:
+                for i, v in enumerate(obj, 1):
+                    convert(v)
+                    lua54.lua_rawseti(L, -2, i)
+
+        try:
+            if not isinstance(obj, (dict, list, tuple)):
+                raise ValueError("Cannot convert %r into a Lua table" % obj)
+            convert(obj)
+            lua54.lua_remove(L, memo_idx)
+        except BaseException:
+            lua54.lua_settop(L, memo_idx - 1)
+            raise
+        return cls._from_runtime_stack(runtime)
     
     def _pushrefval(self):
-        L = self._runtime.L if self.thread is None else self.thread.L
-        lua54.lua_rawgeti(L, lua54.LUA_REGISTRYINDEX, self.ref)
+        runtime = self._runtime if self.thread is None else self.thread.runtime
+        runtime._check_thread()
+        lua54.lua_rawgeti(runtime.L if self.thread is None else self.thread.L, lua54.LUA_REGISTRYINDEX, self.ref)
     
     def __del__(self):
         if self.thread is None:
-            lua54.luaL_unref(self._runtime.L, lua54.LUA_REGISTRYINDEX, self.ref)
+            self._runtime._release_ref(self.ref)
         else:
-            lua54.luaL_unref(self.thread.L, lua54.LUA_REGISTRYINDEX, self.ref)
+            self.thread.runtime._release_ref(self.ref)
     
     def __setitem__(self, k, v):
         rt = self._runtime if self.thread is None else self.thread
@@ -151,9 +320,12 @@ class Table(_LuaReferenceContainer):
             elif isinstance(k, _LuaReferenceContainer):
                 k._pushrefval()
             
+            elif isinstance(k, float):
+                lua54.lua_pushnumber(L, k)
+
             else:
                 k = int(k)
-                lua54.lua_pushnumber(L, k)
+                lua54.lua_pushinteger(L, k)
             
             luavalue = lua54.lua_gettable(L, -2)
             if self.thread is None:
@@ -166,14 +338,23 @@ class Table(_LuaReferenceContainer):
             print("OSError caught: stack top is", lua54.lua_gettop(L))
             raise
 
+    def __hash__(self):
+        self._pushrefval()
+        L = self._runtime.L if self.thread is None else self.thread.L
+        r = lua54.lua_topointer(L, -1)
+        lua54.lua_pop(L, 1)
+        return r
+
     def lua_rawequal(self, other):
         if not isinstance(other, Table):
             return False
         
         t = self._runtime if self.thread is None else self.thread
+        t.runtime._check_thread()
         
-        self._pushrefval()
-        other._pushrefval()
+        # Both onto the same stack, other may belong to a different thread
+        lua54.lua_rawgeti(t.L, lua54.LUA_REGISTRYINDEX, self.ref)
+        lua54.lua_rawgeti(t.L, lua54.LUA_REGISTRYINDEX, other.ref)
         res = lua54.lua_rawequal(t.L, -1, -2) > 0
         lua54.lua_pop(t.L, 2)
         return res
@@ -183,44 +364,180 @@ class Table(_LuaReferenceContainer):
             return False
         
         t = self._runtime if self.thread is None else self.thread
+        t.runtime._check_thread()
         
-        self._pushrefval()
-        other._pushrefval()
+        # Both onto the same stack, other may belong to a different thread
+        lua54.lua_rawgeti(t.L, lua54.LUA_REGISTRYINDEX, self.ref)
+        lua54.lua_rawgeti(t.L, lua54.LUA_REGISTRYINDEX, other.ref)
         res = lua54.lua_compare(t.L, -1, -2, lua54.LUA_OPEQ) > 0
         lua54.lua_pop(t.L, 2)
         return res
 
-    def _getc(self, i):
-        t = self._runtime if self.thread is None else self.thread
-        L = t.L
-        
-        contents = []
-        self._pushrefval()
-        lua54.lua_pushnil(L)
-        while lua54.lua_next(L, -2) != 0:
-            # dumpstack(L)
-            contents.append(Coroutine._to_python_type(t, i))
-            lua54.lua_pop(L, 1)
-            # dumpstack(L)
-            # print(lua54.lua_gettop(L))
-        lua54.lua_pop(L, 1)
-        return contents
+    def _string_type(self):
+        return self._runtime.string_type if self.thread is None else self.thread.string_type
+
+    def _walk(self, i=None):
+        # Walks the table once on a separate Lua thread, so the caller's stack isn't touched between
+        # items. Yields the key (i == -2), the value (i == -1) or both (i is None)
+        runtime = self._runtime if self.thread is None else self.thread.runtime
+        walker = Coroutine(runtime, (), string_type=self._string_type())
+        lua54.lua_rawgeti(walker.L, lua54.LUA_REGISTRYINDEX, runtime._table_walker_ref)
+        lua54.lua_rawgeti(walker.L, lua54.LUA_REGISTRYINDEX, self.ref)
+
+        nargs = 1
+        nresults = ctypes.c_int(0)
+        while True:
+            runtime._resuming += 1
+            ecode = lua54.lua_resume(walker.L, None, nargs, ctypes.pointer(nresults))
+            runtime._resuming -= 1
+            nargs = 0
+            if ecode == lua54.LUA_OK:
+                return
+            elif ecode != lua54.LUA_YIELD:
+                raise LuaRuntimeError(lua54.lua_tolstring(walker.L, -1, None).decode(runtime.encoding))
+
+            if i is None:
+                item = (walker._to_python_type(-2), walker._to_python_type(-1))
+            else:
+                item = walker._to_python_type(i)
+            lua54.lua_pop(walker.L, 2)
+            yield item
 
     def keys(self):
-        return self._getc(-2)
+        return self._walk(-2)
 
     def values(self):
-        return self._getc(-1)
+        return self._walk(-1)
 
     def items(self):
-        return zip(self.keys(), self.values())
+        return self._walk()
 
     def __iter__(self):
-        return iter(self.keys())
+        return self._walk(-2)
+
+    def __len__(self):
+        self._pushrefval()
+        L = self._runtime.L if self.thread is None else self.thread.L
+        n = lua54.lua_rawlen(L, -1)
+        lua54.lua_pop(L, 1)
+        return n
+
+    def __bool__(self):
+        # A table is truthy as in Lua, __len__ is only the border of its sequence part
+        return True
 
     def __contains__(self, key):
         return self[key] is not None
 
+    @classmethod
+    def from_buffer(cls, runtime, obj):
+        # Fills a new sequence with the numbers of a buffer-protocol object (array.array, memoryview,
+        # NumPy arrays, ...). The raw memory goes into Lua as one string and is unpacked there
+        mv = memoryview(obj)
+        fmt = _pack_format(mv.format, mv.itemsize)
+        n = mv.nbytes // mv.itemsize
+        if not mv.c_contiguous or mv.readonly:
+            data = mv.tobytes()
+        else:
+            data = (ctypes.c_char * mv.nbytes).from_buffer(mv.cast("B"))
+
+        runtime._check_thread()
+        L = runtime.L
+        if runtime._array_filler_ref is None:
+            runtime._init_array_helpers()
+        lua54.lua_rawgeti(L, lua54.LUA_REGISTRYINDEX, runtime._array_filler_ref)
+        lua54.lua_createtable(L, n, 0)
+        lua54.lua_pushlstring(L, fmt, len(fmt))
+        lua54.lua_pushlstring(L, data, mv.nbytes)
+        lua54.lua_pushinteger(L, n)
+        if lua54.lua_pcallk(L, 4, 1, 0, 0, None) != lua54.LUA_OK:
+            err = lua54.lua_tolstring(L, -1, None).decode(runtime.encoding)
+            lua54.lua_pop(L, 1)
+            raise LuaRuntimeError(err)
+        return cls._from_runtime_stack(runtime)
+
+    def to_array(self, typecode="d"):
+        # Packs the sequence part of the table into an array.array in Lua and copies it out in one go
+        runtime = self._runtime if self.thread is None else self.thread.runtime
+        runtime._check_thread()
+        result = array.array(typecode)
+        fmt = _pack_format(typecode, result.itemsize)
+        L = runtime.L
+        if runtime._array_dumper_ref is None:
+            runtime._init_array_helpers()
+        lua54.lua_rawgeti(L, lua54.LUA_REGISTRYINDEX, runtime._array_dumper_ref)
+        lua54.lua_rawgeti(L, lua54.LUA_REGISTRYINDEX, self.ref)
+        n = lua54.lua_rawlen(L, -1)
+        lua54.lua_pushlstring(L, fmt, len(fmt))
+        lua54.lua_pushinteger(L, n)
+        if lua54.lua_pcallk(L, 3, 1, 0, 0, None) != lua54.LUA_OK:
+            err = lua54.lua_tolstring(L, -1, None).decode(runtime.encoding)
+            lua54.lua_pop(L, 1)
+            raise LuaRuntimeError(err)
+
+        sz = size_t(0)
+        ptr = lua54.lua_tolstring_p(L, -1, ctypes.pointer(sz))
+        if n > 0:
+            result.frombytes(bytes(sz.value))
+            ctypes.memmove(result.buffer_info()[0], ptr, sz.value)
+        lua54.lua_pop(L, 1)
+        return result
+
+    def to_python(self, deep=True, max_depth=None):
+        # Converts the table in one pass, into a list if its keys are exactly 1..#t and into a dict
+        # otherwise (so empty tables become dicts). Nested tables are converted too if deep is set,
+        # up to max_depth levels below this one, and are left as Table objects otherwise. Recursive
+        # and shared tables become recursive and shared lists and dicts
+        runtime = self._runtime if self.thread is None else self.thread.runtime
+        walker = Coroutine(runtime, (), string_type=self._string_type())
+        L = walker.L
+        memo = {}
+
+        def sequence_length():
+            # Length of the table on top of the stack if it's a non-empty sequence, 0 otherwise
+            n = lua54.lua_rawlen(L, -1)
+            if n == 0:
+                return 0
+            count = 0
+            lua54.lua_pushnil(L)
+            while lua54.lua_next(L, -2) != 0:
+                lua54.lua_pop(L, 1)
+                count += 1
+                if count > n or not lua54.lua_isinteger(L, -1) or not 1 <= lua54.lua_tointegerx(L, -1, None) <= n:
+                    lua54.lua_pop(L, 1)
+                    return 0
+            return n if count == n else 0
+
+        def convert_value(depth):
+            if lua54.lua_type(L, -1) != lua54.LUA_TTABLE or not deep or (max_depth is not None and depth >= max_depth):
+                return walker._to_python_type(-1)
+            elif lua54.lua_topointer(L, -1) in memo:
+                return memo[lua54.lua_topointer(L, -1)]
+            return convert(depth + 1)
+
+        def convert(depth):
+            if not lua54.lua_checkstack(L, 3):
+                raise RecursionError("Table nested too deeply for the Lua stack")
+            n = sequence_length()
+            if n:
+                result = memo[lua54.lua_topointer(L, -1)] = [None] * n
+                for i in range(n):
+                    lua54.lua_rawgeti(L, -1, i + 1)
+                    result[i] = convert_value(depth)
+                    lua54.lua_pop(L, 1)
+                return result
+
+            result = memo[lua54.lua_topointer(L, -1)] = {}
+            lua54.lua_pushnil(L)
+            while lua54.lua_next(L, -2) != 0:
+                k = walker._to_python_type(-2)
+                result[k] = convert_value(depth)
+                lua54.lua_pop(L, 1)
+            return result
+
+        lua54.lua_rawgeti(L, lua54.LUA_REGISTRYINDEX, self.ref)
+        return convert(0)
+
     REPRD_TABLES = None
     def __repr__(self):
         def valid_name(name):
@@ -244,7 +561,7 @@ class Table(_LuaReferenceContainer):
                         return "..."
             
             Table.REPRD_TABLES.append(self)
-            s = "{" + ", ".join("%s=%r" % (k, v) if valid_name(k) else (repr(v) if type(k) is float else "[%r]=%r" % (k, v)) for k, v in sorted(self.items(), key=lambda k: -k if type(k) == int else 1)) + "}"
+            s = "{" + ", ".join("%s=%r" % (k, v) if valid_name(k) else (repr(v) if type(k) in (int, float) else "[%r]=%r" % (k, v)) for k, v in sorted(self.items(), key=lambda k: -k if type(k) == int else 1)) + "}"
 
         finally:
             if clear:
@@ -281,34 +598,97 @@ def dumpstack(L):
 
 class Coroutine():
     
-    def __init__(self, runtime, args, dummy=False):
+    def __init__(self, runtime, args, dummy=False, string_type=None):
         self.started = False
+        self.string_type = runtime.string_type if string_type is None else string_type
         self.ended = dummy
         self.runtime = runtime
+        runtime._check_thread()
+        if runtime._released_threads or len(runtime._released_refs) >= runtime.release_batch_size:
+            runtime._flush_releases()
         self.runtime.threads += 1
         self.args = args
         self.return_value = None
         self._nargs = 0
         self.callback_results = None
+        self.callback_error = None
+        self._in_command = False
+        # Instruction count of the installed hook, 0 if there is none
+        self._hooked = 0
+        self.emitted = None
 
         try:
-            self.L = lua54.lua_newthread(self.runtime.L)
-            self.ref = lua54.luaL_ref(self.runtime.L, lua54.LUA_REGISTRYINDEX)
+            self.L, self.ref = self.runtime._acquire_thread()
         except OSError:
             print("OSError caught: stack top is", lua54.lua_gettop(runtime.L))
             raise
+        self.runtime._thread_objects[self.L] = self
 
     def __del__(self):
-        self.runtime.threads -= 1
-        lua54.luaL_unref(self.runtime.L, lua54.LUA_REGISTRYINDEX, self.ref)
+        if getattr(self, "ref", None) is not None:
+            self.runtime.threads -= 1
+            self.runtime._released_threads.append((self.L, self.ref, self._hooked))
+            if threading.get_ident() != self.runtime.owner_thread:
+                self.runtime._schedule_flush()
     
+    def close(self):
+        # Closes the Lua thread now, running its pending to-be-closed variables, and gives it back to
+        # the runtime. Wrappers created on it keep working through the main thread
+        if self.ref is None:
+            return
+        L, ref = self.L, self.ref
+        self.ended = True
+        self.L = self.runtime.L
+        self.ref = None
+        self.runtime.threads -= 1
+        if self.runtime._thread_objects.get(L) is self:
+            del self.runtime._thread_objects[L]
+        if self._hooked:
+            lua54.lua_sethook(L, lua54.lua_Hook(), 0, 0)
+            self._hooked = 0
+        self.runtime._release_thread(L, ref)
+
     def __aiter__(self):
         return self
 
-    async def __anext__(self):        
+    async def __anext__(self):
         if self.ended:
             raise StopAsyncIteration
-        
+
+        command = self._resume()
+        if command is None:
+            if self.emitted is None:
+                # Preempted by the time slice hook, let the event loop run before resuming
+                await asyncio.sleep(0)
+            return
+
+        command_id, args = command
+        metrics = self.runtime.metrics
+        if metrics is None:
+            try:
+                self.callback_results = await self.runtime.callbacks[command_id][0](self.runtime, *args)
+            except LuaCommandError as e:
+                self.callback_error = str(e)
+            return
+
+        start = time.perf_counter()
+        try:
+            self.callback_results = await self.runtime.callbacks[command_id][0](self.runtime, *args)
+        except BaseException as e:
+            metrics.command(self.runtime.callbacks[command_id][1], time.perf_counter() - start, True)
+            if not isinstance(e, LuaCommandError):
+                raise
+            self.callback_error = str(e)
+        else:
+            metrics.command(self.runtime.callbacks[command_id][1], time.perf_counter() - start, False)
+
+    def _resume(self):
+        # Runs the coroutine until it yields. Returns (command index, arguments) for a command call
+        # and None if it was preempted, raises StopAsyncIteration once it has returned
+        self.emitted = None
+        metrics = self.runtime.metrics
+        if metrics is not None:
+            start = time.perf_counter()
         if not self.started:
             for i in self.args:
                 self._push_python_object(i)
@@ -316,6 +696,19 @@ class Coroutine():
             self.args = None
             self.started = True
 
+        if self._in_command:
+            # The command wrapper expects a status flag before the results
+            self._in_command = False
+            if self.callback_error is not None:
+                msg = self.callback_error.encode(self.runtime.encoding, "replace")
+                lua54.lua_pushboolean(self.L, 0)
+                lua54.lua_pushlstring(self.L, msg, len(msg))
+                self._nargs = 2
+                self.callback_error = None
+            else:
+                lua54.lua_pushboolean(self.L, 1)
+                self._nargs = 1
+
         if self.callback_results is not None:
             if isinstance(self.callback_results, tuple):
                 for i in self.callback_results:
@@ -326,45 +719,82 @@ class Coroutine():
                 self._nargs += 1
             
             self.callback_results = None
+
+        if metrics is not None:
+            metrics.marshal_time += time.perf_counter() - start
+            start = time.perf_counter()
+
+        if self._hooked != self.runtime._hook_count:
+            if self.runtime._hook_count:
+                lua54.lua_sethook(self.L, self.runtime._hook_trampoline, lua54.LUA_MASKCOUNT, self.runtime._hook_count)
+            else:
+                lua54.lua_sethook(self.L, lua54.lua_Hook(), 0, 0)
+            self._hooked = self.runtime._hook_count
+        if self.runtime.slice_instructions is not None or self.runtime.slice_seconds is not None:
+            self.runtime._slice_executed = 0
+            self.runtime._slice_start = time.perf_counter()
         
         nresults = ctypes.c_int(0)
+        self.runtime._resume_count += 1
+        self.runtime._memory_limit_active = True
+        self.runtime._resuming += 1
         ecode = lua54.lua_resume(self.L, None, self._nargs, ctypes.pointer(nresults))
+        self.runtime._resuming -= 1
+        self.runtime._memory_limit_active = False
         self._nargs = 0
+        command_id = None
+        if ecode == lua54.LUA_YIELD and nresults.value > 0:
+            command_id = lua54.lua_tointegerx(self.L, -nresults.value, None)
+        if metrics is not None:
+            metrics.resume(time.perf_counter() - start, ecode, command_id)
         if ecode == lua54.LUA_OK:
             self.ended = True
-            self.return_value = []
-            for _ in range(lua54.lua_gettop(self.L)):
-                self.return_value.append(self._to_python_type(-1))
-                lua54.lua_pop(self.L, 1)
-            self.return_value = tuple(reversed(self.return_value))
+            self.return_value = tuple(self._get_args(lua54.lua_gettop(self.L)))
             raise StopAsyncIteration
 
         elif ecode == lua54.LUA_ERRRUN:
+            self.ended = True
             raise LuaRuntimeError(lua54.lua_tolstring(self.L, -1, None).decode(self.runtime.encoding))
 
         elif ecode == lua54.LUA_ERRMEM:
+            self.ended = True
             raise MemoryError
 
         elif ecode == lua54.LUA_ERRERR:
+            self.ended = True
             raise ValueError("error handler function failed")
         
-        expected_nresults = int(lua54.lua_tonumberx(self.L, -1, None))
-        lua54.lua_pop(self.L, 1)
-        
-        command_name = lua54.lua_tolstring(self.L, -1, None).decode(self.runtime.encoding)
-        lua54.lua_pop(self.L, 1)
-        
-        if expected_nresults != nresults.value - 2:
-            raise ValueError("Command %r expected %d arguments, got %d" % (command_name, expected_nresults, nresults.value - 2))
+        if nresults.value == 0:
+            return None
+
+        # Yielded by the command wrapper: the command index followed by the arguments
+        nargs = nresults.value - 1
+        if command_id == -1:
+            # Values from emit(), returned to the Lua side with no status flag
+            self.emitted = tuple(self._get_args(nargs))
+            lua54.lua_pop(self.L, 1)
+            return None
+
+        f, command_name, expected_nargs = self.runtime.callbacks[command_id]
+        if expected_nargs is not None and expected_nargs != nargs:
+            raise ValueError("Command %r expected %d arguments, got %d" % (command_name, expected_nargs, nargs))
 
-        self.callback_results = await self.runtime.callbacks[command_name](self.runtime, *self._get_args(expected_nresults))
+        args = self._get_args(nargs)
+        lua54.lua_pop(self.L, 1)
+        self._in_command = True
+        return command_id, args
     
     def _get_args(self, n):
-        results = []
-        for _ in range(n):
-            results.append(self._to_python_type(-1))
-            lua54.lua_pop(self.L, 1)
-        return results[::-1]
+        # Converts and pops the top n values
+        metrics = self.runtime.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+        top = lua54.lua_gettop(self.L)
+        results = [self._to_python_type(i) for i in range(top - n + 1, top + 1)]
+        lua54.lua_settop(self.L, top - n)
+        if metrics is not None:
+            metrics.marshal_time += time.perf_counter() - start
+        return results
 
     def _push_python_object(self, obj):
         if obj is None:
@@ -376,6 +806,9 @@ class Coroutine():
         elif obj is True:
             lua54.lua_pushboolean(self.L, 1)
 
+        elif isinstance(obj, int) and -2**63 <= obj < 2**63:
+            lua54.lua_pushinteger(self.L, obj)
+
         elif isinstance(obj, (int, float)):
             lua54.lua_pushnumber(self.L, obj)
 
@@ -389,16 +822,41 @@ class Coroutine():
         elif isinstance(obj, Table):
             if isinstance(self, Coroutine) and obj._get_owner() is None:
                 obj._set_owner(self)
-            obj._pushrefval()
+            lua54.lua_rawgeti(self.L, lua54.LUA_REGISTRYINDEX, obj.ref)
+
+        elif isinstance(obj, _LuaReferenceContainer):
+            lua54.lua_rawgeti(self.L, lua54.LUA_REGISTRYINDEX, obj.ref)
         
+        elif isinstance(obj, Proxy):
+            self.runtime._push_proxy(obj.obj)
+            if self.L != self.runtime.L:
+                lua54.lua_xmove(self.runtime.L, self.L, 1)
+
         elif callable(obj):
             # Assuming coroutine
-            cf = lua54.lua_CFunction(self.runtime._function_callback_gen(obj, "@CB" + str(id(obj))))
-            self.runtime._CFUNCTIONS.append(cf)
-            lua54.lua_pushcclosure(self.L, cf, 0)
+            self.runtime._push_callable(obj)
+            if self.L != self.runtime.L:
+                lua54.lua_xmove(self.runtime.L, self.L, 1)
         
         else:
-            raise ValueError("Cannot convert %r into a Lua type" % obj)
+            try:
+                mv = memoryview(obj)
+            except TypeError:
+                raise ValueError("Cannot convert %r into a Lua type" % obj) from None
+
+            # Any other buffer becomes a string, read in place when it's contiguous and writable
+            if mv.c_contiguous and not mv.readonly:
+                data = (ctypes.c_char * mv.nbytes).from_buffer(mv.cast("B"))
+            else:
+                data = mv.tobytes()
+            lua54.lua_pushlstring(self.L, data, mv.nbytes)
+
+    def _push_proxy_result(self, obj):
+        # Values read through a proxy stay lazy, callables included (called synchronously as they are)
+        if obj is None or isinstance(obj, (bool, int, float, str, bytes, _LuaReferenceContainer, Proxy)):
+            Coroutine._push_python_object(self, obj)
+        else:
+            Coroutine._push_python_object(self, Proxy(obj))
 
     def _to_python_type(self, item_n):
         item_type = lua54.lua_type(self.L, item_n)
@@ -409,72 +867,506 @@ class Coroutine():
             return lua54.lua_toboolean(self.L, item_n) > 0
         
         elif item_type == lua54.LUA_TNUMBER:
+            if lua54.lua_isinteger(self.L, item_n):
+                return lua54.lua_tointegerx(self.L, item_n, None)
             return lua54.lua_tonumberx(self.L, item_n, None)
 
         elif item_type == lua54.LUA_TSTRING:
             sz = size_t(0)
-            s = lua54.lua_tolstring(self.L, item_n, ctypes.pointer(sz))
-            if s is None:
-                return ""
-            return s[:sz.value].decode(self.runtime.encoding)
+            ptr = lua54.lua_tolstring_p(self.L, item_n, ctypes.pointer(sz))
+            if self.string_type is memoryview:
+                # Lua never moves strings, so the memory stays valid while the string is referenced
+                buf = (ctypes.c_char * sz.value).from_address(ptr)
+                buf.string_ref = _LuaReferenceContainer(self, item_n)
+                return memoryview(buf).cast("B").toreadonly()
+
+            s = ctypes.string_at(ptr, sz.value)
+            if self.string_type is bytes:
+                return s
+            return s.decode(self.runtime.encoding)
 
         elif item_type == lua54.LUA_TTABLE:
-            refs = []
-            if item_n > 0:
-                item_n = lua54.lua_gettop(self.L) - item_n - 1
-            for i in range(-item_n - 1):
-                refs.append(lua54.luaL_ref(self.L, lua54.LUA_REGISTRYINDEX))
-            
-            t = Table(self)
-            
-            for i in reversed(refs):
-                lua54.lua_rawgeti(self.L, lua54.LUA_REGISTRYINDEX, i)
-                lua54.luaL_unref(self.L, lua54.LUA_REGISTRYINDEX, i)
-            
-            return t
+            return Table(self, item_n)
 
         elif item_type == lua54.LUA_TFUNCTION:
-            refs = []
-            if item_n > 0:
-                item_n = lua54.lua_gettop(self.L) - item_n - 1
-            for i in range(-item_n - 1):
-                refs.append(lua54.luaL_ref(self.L, lua54.LUA_REGISTRYINDEX))
-            
-            f = Function(self)
-            
-            for i in reversed(refs):
-                lua54.lua_rawgeti(self.L, lua54.LUA_REGISTRYINDEX, i)
-                lua54.luaL_unref(self.L, lua54.LUA_REGISTRYINDEX, i)
-            
-            return f
+            return Function(self, item_n)
+
+        elif item_type == lua54.LUA_TUSERDATA and self.runtime._is_proxy(self.L, item_n):
+            return self.runtime._proxies[ctypes.c_longlong.from_address(lua54.lua_touserdata(self.L, item_n)).value]
 
         else:
             raise ValueError("Cannot convert %s to Python type" % ([
                 "nil", "boolean", "lightuserdata", "number", "string", "table", "function", "userdata", "thread"
             ][item_type]))
 
+# Raises the error reported by a C function following the status flag protocol of
+# Runtime._call_with_status, or returns its results
+_STATUS_CHECK = """
+local error = ...
+return function(ok, ...)
+    if not ok then
+        error(..., 2)
+    end
+    return ...
+end
+"""
+
+_COMMAND_WRAPPER = """
+local yield, check = ...
+return function(id, f, keepalive)
+    if f ~= nil then
+        return function(...)
+            return check(f(...))
+        end
+    end
+    return function(...)
+        local _ = keepalive
+        return check(yield(id, ...))
+    end
+end
+"""
+
+# Wrappers for Python callables passed into Lua are cached per command index. Each one carries a
+# sentinel upvalue whose __gc tells the runtime the wrapper is gone, so the index can be reused
+_CALLABLE_INTERNER = """
+local wrap, setmetatable, release = ...
+local cache = setmetatable({}, {__mode = "v"})
+local sentinel_mt = {__gc = function(sentinel) release(sentinel[1]) end}
+return function(id)
+    local f = cache[id]
+    if f ~= nil then
+        return f, false
+    end
+    f = wrap(id, nil, setmetatable({id}, sentinel_mt))
+    cache[id] = f
+    return f, true
+end
+"""
+
+# Proxies are interned per object like callable wrappers. Every metamethod but __gc goes through a C
+# function returning a status flag, the error is raised here
+_PROXY_METATABLE = """
+local mt, setmetatable, check, new, index, newindex, call, len, release = ...
+local cache = setmetatable({}, {__mode = "v"})
+mt.__index = function(p, k) return check(index(p, k)) end
+mt.__newindex = function(p, k, v) check(newindex(p, k, v)) end
+mt.__call = function(p, ...) return check(call(p, ...)) end
+mt.__len = function(p) return check(len(p)) end
+mt.__gc = release
+mt.__name = "python object"
+mt.__metatable = false
+return function(id)
+    local p = cache[id]
+    if p ~= nil then
+        return p, false
+    end
+    p = new(id)
+    cache[id] = p
+    return p, true
+end
+"""
+
+# emit(...) hands values to a Function.stream() consumer, marked with command index -1
+_EMITTER = """
+local yield = ...
+return function(...)
+    yield(-1, ...)
+end
+"""
+
+_TABLE_WALKER = """
+local yield, next = ...
+return function(t)
+    for k, v in next, t do
+        yield(k, v)
+    end
+end
+"""
+
+_ARRAY_FILLER = """
+local string, table = ...
+local unpack, rep, move = string.unpack, string.rep, table.move
+local CHUNK = 128
+return function(t, fmt, s, n)
+    local chunk = rep(fmt, CHUNK)
+    local pos = 1
+    local i = 1
+    while i + CHUNK - 1 <= n do
+        local values = {unpack(chunk, s, pos)}
+        pos = values[CHUNK + 1]
+        move(values, 1, CHUNK, i, t)
+        i = i + CHUNK
+    end
+    for j = i, n do
+        t[j], pos = unpack(fmt, s, pos)
+    end
+    return t
+end
+"""
+
+_ARRAY_DUMPER = """
+local string, table = ...
+local pack, rep, unpack, concat = string.pack, string.rep, table.unpack, table.concat
+local CHUNK = 128
+return function(t, fmt, n)
+    local parts = {}
+    local chunk = rep(fmt, CHUNK)
+    local i = 1
+    while i + CHUNK - 1 <= n do
+        parts[#parts + 1] = pack(chunk, unpack(t, i, i + CHUNK - 1))
+        i = i + CHUNK
+    end
+    parts[#parts + 1] = pack(rep(fmt, n - i + 1), unpack(t, i, n))
+    return concat(parts)
+end
+"""
+
+def _pack_format(fmt, itemsize):
+    # Converts a struct/array/memoryview format of a single number into a string.pack format
+    byteorder = "="
+    if fmt[:1] in ("@", "=", "<", ">", "!"):
+        byteorder = {"@": "=", "!": ">"}.get(fmt[0], fmt[0])
+        fmt = fmt[1:]
+
+    if fmt in ("f", "d"):
+        code = fmt
+    elif fmt in ("b", "h", "i", "l", "q", "n"):
+        code = "i%d" % itemsize
+    elif fmt in ("B", "H", "I", "L", "Q", "N"):
+        code = "I%d" % itemsize
+    else:
+        raise ValueError("Unsupported buffer format %r" % fmt)
+    return (byteorder + code).encode("ascii")
+
+_GLOBALS_SNAPSHOT = """
+local getmetatable, setmetatable = ...
+local next, type, rawset = next, type, rawset
+return function(root)
+    local saved = {}
+    local metatables = {}
+    local function walk(t)
+        if saved[t] ~= nil then
+            return
+        end
+        local copy = {}
+        saved[t] = copy
+        metatables[t] = getmetatable(t) or false
+        for k, v in next, t do
+            copy[k] = v
+            if type(k) == "table" then
+                walk(k)
+            end
+            if type(v) == "table" then
+                walk(v)
+            end
+        end
+    end
+    walk(root)
+
+    return function()
+        for t, copy in next, saved do
+            setmetatable(t, nil)
+            for k in next, t do
+                if copy[k] == nil then
+                    rawset(t, k, nil)
+                end
+            end
+            for k, v in next, copy do
+                rawset(t, k, v)
+            end
+            setmetatable(t, metatables[t] or nil)
+        end
+    end
+end
+"""
+
+class RuntimeMetrics():
+    # Counters for one Runtime, only kept while metrics are enabled. Latency histogram buckets are
+    # upper bounds in seconds, the last one catches everything slower
+
+    BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float("inf"))
+
+    def __init__(self):
+        self.resumes = 0
+        self.resume_time = 0.0
+        self.yields = 0
+        self.emits = 0
+        self.preemptions = 0
+        self.returns = 0
+        self.errors = 0
+        self.marshal_time = 0.0
+        self.commands = {}
+
+    def resume(self, elapsed, status, command_id):
+        # command_id is what a yield passed first, None if it passed nothing (time slicing)
+        self.resumes += 1
+        self.resume_time += elapsed
+        if status == lua54.LUA_YIELD:
+            if command_id is None:
+                self.preemptions += 1
+            elif command_id == -1:
+                self.emits += 1
+            else:
+                self.yields += 1
+        elif status == lua54.LUA_OK:
+            self.returns += 1
+        else:
+            self.errors += 1
+
+    def command(self, name, elapsed, failed):
+        stats = self.commands.get(name)
+        if stats is None:
+            stats = self.commands[name] = {"calls": 0, "errors": 0, "time": 0.0, "histogram": [0] * len(self.BUCKETS)}
+        stats["calls"] += 1
+        stats["errors"] += failed
+        stats["time"] += elapsed
+        stats["histogram"][bisect.bisect_left(self.BUCKETS, elapsed)] += 1
+
+    def snapshot(self):
+        return {
+            "resumes": self.resumes,
+            "resume_time": self.resume_time,
+            "yields": self.yields,
+            "emits": self.emits,
+            "preemptions": self.preemptions,
+            "returns": self.returns,
+            "errors": self.errors,
+            "marshal_time": self.marshal_time,
+            "buckets": self.BUCKETS,
+            "commands": {name: dict(stats, histogram=list(stats["histogram"])) for name, stats in self.commands.items()},
+        }
+
+class Profiler():
+    # Sampling profiler fed by the runtime's count hook. Counts samples per function (where the
+    # sample landed), per source line and per folded stack (root first, as flamegraph.pl expects)
+
+    def __init__(self, runtime, interval=10000, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.encoding = runtime.encoding
+        self.samples = 0
+        self.functions = collections.Counter()
+        self.lines = collections.Counter()
+        self.stacks = collections.Counter()
+        self._countdown = interval
+        self._ar = lua54.lua_Debug()
+
+    def _tick(self, state, count):
+        self._countdown -= count
+        if self._countdown > 0:
+            return
+        self._countdown = self.interval
+        self._sample(state)
+
+    def _sample(self, L):
+        ar = self._ar
+        frames = []
+        level = 0
+        while level < self.max_depth and lua54.lua_getstack(L, level, ctypes.byref(ar)):
+            lua54.lua_getinfo(L, b"nSl", ctypes.byref(ar))
+            src = ar.short_src.decode(self.encoding, "replace")
+            if ar.what == b"C":
+                label = "[C] %s" % (ar.name.decode(self.encoding, "replace") if ar.name else "?")
+            elif ar.what == b"main":
+                label = "main chunk (%s)" % src
+            elif ar.name:
+                label = "%s (%s:%d)" % (ar.name.decode(self.encoding, "replace"), src, ar.linedefined)
+            else:
+                # Called from Python, Lua has no name for it
+                label = "function <%s:%d>" % (src, ar.linedefined)
+            if level == 0:
+                self.functions[label] += 1
+                if ar.currentline > 0:
+                    self.lines[(src, ar.currentline)] += 1
+            frames.append(label)
+            level += 1
+
+        if frames:
+            self.samples += 1
+            self.stacks[";".join(reversed(frames))] += 1
+
+    def top_functions(self, n=20):
+        return self.functions.most_common(n)
+
+    def top_lines(self, n=20):
+        return [("%s:%d" % key, samples) for key, samples in self.lines.most_common(n)]
+
+    def folded(self):
+        # Folded stacks, one "frame;frame;frame count" line per distinct stack
+        return "".join("%s %d\n" % (stack, samples) for stack, samples in self.stacks.items())
+
+    def write_folded(self, path):
+        with open(path, "w") as f:
+            f.write(self.folded())
+
+    def clear(self):
+        self.samples = 0
+        self.functions.clear()
+        self.lines.clear()
+        self.stacks.clear()
+
+class ChunkCache():
+    # Compiled top-level chunks, keyed by a hash of the source and chunkname. Can be shared by any
+    # number of runtimes. Chunks are kept in memory (least recently used ones are dropped past
+    # max_entries) and, if directory is given, on disk. Bytecode isn't verified when loaded, so the
+    # directory must not be writable by anyone untrusted
+
+    def __init__(self, max_entries=64, directory=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self._chunks = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _key(self, source, chunkname):
+        return hashlib.sha256(b"%d:%s\0%s" % (len(chunkname), chunkname, source)).hexdigest()
+
+    def _get(self, key):
+        chunk = self._chunks.get(key)
+        if chunk is not None:
+            self._chunks.move_to_end(key)
+            return chunk
+
+        if self.directory is not None:
+            try:
+                with open(os.path.join(self.directory, key + ".luac"), "rb") as f:
+                    chunk = f.read()
+            except OSError:
+                return None
+            self._put(key, chunk, False)
+        return chunk
+
+    def _put(self, key, chunk, persist=True):
+        self._chunks[key] = chunk
+        self._chunks.move_to_end(key)
+        while len(self._chunks) > self.max_entries:
+            self._chunks.popitem(last=False)
+
+        if persist and self.directory is not None:
+            path = os.path.join(self.directory, key + ".luac")
+            tmp = "%s.%d.tmp" % (path, os.getpid())
+            try:
+                with open(tmp, "wb") as f:
+                    f.write(chunk)
+                os.replace(tmp, path)
+            except OSError:
+                pass
+
+    def _load(self, L, source, chunkname):
+        # Pushes the cached compiled chunk, returns False (with nothing pushed) if there's none
+        chunk = self._get(self._key(source, chunkname))
+        if chunk is not None:
+            if lua54.luaL_loadbufferx(L, chunk, len(chunk), chunkname, b"b") == lua54.LUA_OK:
+                self.hits += 1
+                return True
+            # Most likely dumped by a different Lua version
+            lua54.lua_pop(L, 1)
+        self.misses += 1
+        return False
+
+    def _store(self, L, source, chunkname):
+        # Dumps the function on top of the stack
+        chunk = _dump_function(L)
+        if chunk is not None:
+            self._put(self._key(source, chunkname), chunk)
+
+    def clear(self):
+        self._chunks.clear()
+
+def _dump_function(L):
+    # Bytecode of the function on top of the stack, which stays there. None if it can't be dumped
+    parts = []
+    def writer(state, p, sz, ud):
+        parts.append(ctypes.string_at(p, sz))
+        return 0
+
+    if lua54.lua_dump(L, lua54.lua_Writer(writer), None, 0) != 0:
+        return None
+    return b"".join(parts)
+
+# Compiled helper chunks by source, shared by every runtime of the process
+_helper_chunks = {}
+
 class Runtime():
     
-    def __init__(self, code, encoding="ascii", filename=None):
+    def __init__(self, code, encoding="ascii", filename=None, thread_pool_size=32, string_type=str, chunk_cache=None, memory_limit=None, track_memory=False):
         self._CFUNCTIONS = []
         self.encoding = encoding
+        # str, bytes (no decoding) or memoryview (no decoding or copying)
+        self.string_type = string_type
         self.runtime = self
         self.threads = 0
+        # Only the owner thread may touch the lua_State
+        self.owner_thread = threading.get_ident()
+        self.owner_loop = None
+        # Finalizers never touch Lua themselves (they may run mid-resume or on another thread), they
+        # queue their registry refs and coroutine threads, which are freed in batches at safe points
+        self.release_batch_size = 64
+        self.live_references = 0
+        self._released_refs = []
+        self._released_threads = []
+        self._released_total = 0
+        self._flush_scheduled = False
+        # Nesting depth of lua_resume calls, refs are never freed while one is running
+        self._resuming = 0
+        self._thread_objects = weakref.WeakValueDictionary()
+        self.thread_pool_size = thread_pool_size
+        self.scheduler = None
+        self._globals_snapshot_ref = None
+        self._globals_restore_ref = None
+        self.slice_instructions = None
+        self.slice_seconds = None
+        self.slice_check_interval = 10000
+        self._slice_executed = 0
+        self._slice_start = 0
+        self.profiler = None
+        # Count hook shared by time slicing and the profiler, installed on each thread as it's resumed
+        self._hook_count = 0
+        self._hook_trampoline = lua54.lua_Hook(self._hook)
+        self._idle_threads = []
+        self._thread_pool_stats = {"created": 0, "reused": 0, "returned": 0, "discarded": 0}
+        # The accounting allocator is a Python callback on every allocation, so it's only used when
+        # asked for. The limit only applies while script code runs (a failed allocation in an API
+        # call made from Python would panic instead of raising)
+        self.memory_limit = memory_limit
+        self.memory_used = 0
+        self.memory_peak = 0
+        self._memory_failures = 0
+        self._memory_limit_active = False
+        self._resume_count = 0
+        self._idle_gc_task = None
+        # RuntimeMetrics when enabled, hot paths only check for None
+        self.metrics = None
+        self._metrics_exporters = []
         
-        self.L = lua54.luaL_newstate()
-        ecode = code.encode(self.encoding)
-        if filename is None:
-            lua54.luaL_loadstring(self.L, ecode)
+        if memory_limit is None and not track_memory:
+            self._allocator = None
+            self.L = lua54.luaL_newstate()
         else:
-            lua54.luaL_loadbufferx(self.L, ecode, len(ecode), b"@" + filename.encode(self.encoding), None)
-        
-        if lua54.lua_type(self.L, -1) == lua54.LUA_TSTRING:
-            raise ValueError(lua54.lua_tolstring(self.L, -1, None).decode(self.encoding))
+            self._allocator = lua54.lua_Alloc(self._alloc)
+            self.L = lua54.lua_newstate(self._allocator, None)
+        ecode = code.encode(self.encoding)
+        chunkname = ecode if filename is None else b"@" + filename.encode(self.encoding)
+        if chunk_cache is None or not chunk_cache._load(self.L, ecode, chunkname):
+            if filename is None:
+                lua54.luaL_loadstring(self.L, ecode)
+            else:
+                lua54.luaL_loadbufferx(self.L, ecode, len(ecode), chunkname, None)
+
+            if lua54.lua_type(self.L, -1) == lua54.LUA_TSTRING:
+                raise ValueError(lua54.lua_tolstring(self.L, -1, None).decode(self.encoding))
+
+            if chunk_cache is not None:
+                chunk_cache._store(self.L, ecode, chunkname)
         
         lua54.luaopen_base(self.L)
         lua54.lua_pop(self.L, 1)
         
+        self._memory_limit_active = True
         ecode = lua54.lua_pcallk(self.L, 0, 0, 0, 0, None)
+        self._memory_limit_active = False
         if ecode == lua54.LUA_YIELD:
             raise AssertionError("lua_pcallk returned LUA_YIELD")
 
@@ -485,27 +1377,391 @@ class Runtime():
             raise LuaRuntimeError(lua54.lua_tolstring(self.L, -1, None).decode(self.encoding))
 
         elif ecode == lua54.LUA_ERRMEM:
-            if self.lua54.lua_gettop(self.L) > 0:
+            if lua54.lua_gettop(self.L) > 0:
                 raise MemoryError(lua54.lua_tolstring(self.L, -1, None).decode(self.encoding))
             raise MemoryError
 
         self.dummy_coroutine = Coroutine(self, (), dummy=True)
 
-        self.callbacks = {}
-    
-    def _register(self, name, f):
-        cf = lua54.lua_CFunction(f)
-        self._CFUNCTIONS.append(cf)
-        lua54.lua_pushcclosure(self.L, cf, 0)
-        lua54.lua_setglobal(self.L, name)
+        # Commands are indexed by their position in this list, the index is baked into the Lua side
+        # wrapper closure as an upvalue
+        self.callbacks = []
+        self._sync_trampoline = lua54.lua_CFunction(self._sync_command_callback)
+        self._CFUNCTIONS.append(self._sync_trampoline)
+
+        lua54.luaopen_coroutine(self.L)
+        lua54.lua_getfield(self.L, -1, b"yield")
+        lua54.lua_remove(self.L, -2)
+        lua54.lua_pushvalue(self.L, -1)
+        lua54.lua_pushvalue(self.L, -1)
+        lua54.lua_getglobal(self.L, b"error")
+        self._status_check_ref = self._load_helper(_STATUS_CHECK, 1)
+        lua54.lua_rawgeti(self.L, lua54.LUA_REGISTRYINDEX, self._status_check_ref)
+        self._command_wrapper_ref = self._load_helper(_COMMAND_WRAPPER, 2)
+        emitter_ref = self._load_helper(_EMITTER, 1)
+        # Scripts may have their own emit
+        if lua54.lua_getglobal(self.L, b"emit") == lua54.LUA_TNIL:
+            lua54.lua_rawgeti(self.L, lua54.LUA_REGISTRYINDEX, emitter_ref)
+            lua54.lua_setglobal(self.L, b"emit")
+        lua54.lua_pop(self.L, 1)
+        lua54.luaL_unref(self.L, lua54.LUA_REGISTRYINDEX, emitter_ref)
+        lua54.lua_getglobal(self.L, b"next")
+        self._table_walker_ref = self._load_helper(_TABLE_WALKER, 2)
+
+        self._free_command_ids = []
+        self._interned_callables = {}
+        self._callable_refs = {}
+        self._release_trampoline = lua54.lua_CFunction(self._release_callable)
+        self._CFUNCTIONS.append(self._release_trampoline)
+        lua54.lua_rawgeti(self.L, lua54.LUA_REGISTRYINDEX, self._command_wrapper_ref)
+        lua54.lua_getglobal(self.L, b"setmetatable")
+        lua54.lua_pushcclosure(self.L, self._release_trampoline, 0)
+        self._callable_interner_ref = self._load_helper(_CALLABLE_INTERNER, 3)
+
+        # Array transfer and proxies are set up on first use
+        self._array_filler_ref = None
+        self._array_dumper_ref = None
+        self._proxies = {}
+        self._proxy_ids = {}
+        self._proxy_refs = {}
+        self._next_proxy_id = itertools.count()
+        self._proxy_metatable_ref = None
+        self._proxy_interner_ref = None
+
+    def _init_array_helpers(self):
+        lua54.luaopen_string(self.L)
+        # luaopen_string also gives strings a metatable, which scripts never had access to before
+        lua54.lua_pushlstring(self.L, b"", 0)
+        lua54.lua_pushnil(self.L)
+        lua54.lua_setmetatable(self.L, -2)
+        lua54.lua_pop(self.L, 1)
+        lua54.luaopen_table(self.L)
+        lua54.lua_pushvalue(self.L, -2)
+        lua54.lua_pushvalue(self.L, -2)
+        self._array_filler_ref = self._load_helper(_ARRAY_FILLER, 2)
+        self._array_dumper_ref = self._load_helper(_ARRAY_DUMPER, 2)
+
+    def _init_proxies(self):
+        lua54.lua_createtable(self.L, 0, 8)
+        lua54.lua_pushvalue(self.L, -1)
+        self._proxy_metatable_ref = lua54.luaL_ref(self.L, lua54.LUA_REGISTRYINDEX)
+        lua54.lua_getglobal(self.L, b"setmetatable")
+        lua54.lua_rawgeti(self.L, lua54.LUA_REGISTRYINDEX, self._status_check_ref)
+        for f in (self._new_proxy, self._proxy_callback(self._proxy_index), self._proxy_callback(self._proxy_newindex),
+                  self._proxy_callback(self._proxy_call), self._proxy_callback(len), self._release_proxy):
+            cf = lua54.lua_CFunction(f)
+            self._CFUNCTIONS.append(cf)
+            lua54.lua_pushcclosure(self.L, cf, 0)
+        self._proxy_interner_ref = self._load_helper(_PROXY_METATABLE, 9)
+
+    def _load_helper(self, source, nargs=0):
+        # Runs a chunk of helper code with the nargs values on top of the stack as its arguments and
+        # keeps the value it returns in the registry
+        source = source.encode("ascii")
+        chunk = _helper_chunks.get(source)
+        if chunk is None:
+            if lua54.luaL_loadstring(self.L, source) != lua54.LUA_OK:
+                raise AssertionError(lua54.lua_tolstring(self.L, -1, None).decode(self.encoding))
+            _helper_chunks[source] = _dump_function(self.L)
+        elif lua54.luaL_loadbufferx(self.L, chunk, len(chunk), source, b"b") != lua54.LUA_OK:
+            raise AssertionError(lua54.lua_tolstring(self.L, -1, None).decode(self.encoding))
+        lua54.lua_rotate(self.L, -nargs - 1, 1)
+        if lua54.lua_pcallk(self.L, nargs, 1, 0, 0, None) != lua54.LUA_OK:
+            raise AssertionError(lua54.lua_tolstring(self.L, -1, None).decode(self.encoding))
+        return lua54.luaL_ref(self.L, lua54.LUA_REGISTRYINDEX)
     
+    def set_time_slice(self, instructions=None, seconds=None, check_interval=10000):
+        # Makes running coroutines yield back to the event loop after executing `instructions` VM
+        # instructions or running for `seconds`, checked every `check_interval` instructions.
+        # Call with no arguments to turn it off
+        self._check_thread()
+        self.slice_instructions = instructions
+        self.slice_seconds = seconds
+        if instructions is not None:
+            check_interval = min(check_interval, instructions)
+        self.slice_check_interval = check_interval
+        self._update_hook_count()
+
+    def _update_hook_count(self):
+        counts = []
+        if self.slice_instructions is not None or self.slice_seconds is not None:
+            counts.append(self.slice_check_interval)
+        if self.profiler is not None:
+            counts.append(self.profiler.interval)
+        self._hook_count = min(counts, default=0)
+
+    def start_profiler(self, interval=10000, max_depth=64):
+        # Samples the Lua stack every `interval` VM instructions on every thread of this runtime
+        self._check_thread()
+        self.profiler = Profiler(self, interval, max_depth)
+        self._update_hook_count()
+        return self.profiler
+
+    def stop_profiler(self):
+        self._check_thread()
+        profiler, self.profiler = self.profiler, None
+        self._update_hook_count()
+        return profiler
+
+    def _hook(self, state, ar):
+        if self.profiler is not None:
+            self.profiler._tick(state, self._hook_count)
+        if self.slice_instructions is None and self.slice_seconds is None:
+            return
+
+        self._slice_executed += self._hook_count
+        out_of_instructions = self.slice_instructions is not None and self._slice_executed >= self.slice_instructions
+        out_of_time = self.slice_seconds is not None and time.perf_counter() - self._slice_start >= self.slice_seconds
+
+        # Yielding from a count hook doesn't longjmp out of this function: Lua only marks the thread
+        # as yielding and unwinds after the hook has returned
+        if (out_of_instructions or out_of_time) and lua54.lua_isyieldable(state):
+            lua54.lua_yieldk(state, 0, None, None)
+
+    def _acquire_thread(self):
+        # Returns a (lua_State, registry ref) pair, taken from the idle pool if possible
+        if self._idle_threads:
+            self._thread_pool_stats["reused"] += 1
+            return self._idle_threads.pop()
+
+        self._thread_pool_stats["created"] += 1
+        L = lua54.lua_newthread(self.L)
+        return L, lua54.luaL_ref(self.L, lua54.LUA_REGISTRYINDEX)
+
+    def _release_thread(self, L, ref):
+        # Always closed first so to-be-closed variables run even when the thread is discarded. A
+        # thread that ended with an error isn't reused, its stale stack slots could keep garbage
+        # alive (past a memory limit, Lua's emergency collection can't free it)
+        errored = lua54.lua_status(L) not in (lua54.LUA_OK, lua54.LUA_YIELD)
+        with self._memory_limited():
+            status = lua54.lua_closethread(L, None)
+        if status == lua54.LUA_OK and not errored and len(self._idle_threads) < self.thread_pool_size:
+            self._thread_pool_stats["returned"] += 1
+            self._idle_threads.append((L, ref))
+            return
+
+        self._thread_pool_stats["discarded"] += 1
+        lua54.luaL_unref(self.L, lua54.LUA_REGISTRYINDEX, ref)
+
+    def _check_thread(self):
+        if threading.get_ident() != self.owner_thread:
+            raise RuntimeError("Runtime used outside of its owner thread, use call_threadsafe instead")
+
+    def set_owner_thread(self):
+        # Hands the runtime over to the calling thread
+        self.owner_thread = threading.get_ident()
+        self.owner_loop = None
+        self._flush_releases()
+
+    def _release_ref(self, ref):
+        self.live_references -= 1
+        self._released_refs.append(ref)
+        if threading.get_ident() != self.owner_thread:
+            self._schedule_flush()
+        elif len(self._released_refs) >= self.release_batch_size:
+            if self._resuming:
+                self._schedule_flush()
+            else:
+                # A safe point already, don't count on there being a loop
+                self._flush_refs()
+
+    def _schedule_flush(self):
+        if self._flush_scheduled:
+            return
+        try:
+            self.owner_loop.call_soon_threadsafe(self._flush_releases)
+            self._flush_scheduled = True
+        except (AttributeError, RuntimeError):
+            # No loop or it's closed, the queues are flushed when the runtime is next used
+            pass
+
+    def _flush_refs(self):
+        refs, self._released_refs = self._released_refs, []
+        for ref in refs:
+            lua54.luaL_unref(self.L, lua54.LUA_REGISTRYINDEX, ref)
+        self._released_total += len(refs)
+
+    def _flush_releases(self):
+        self._flush_scheduled = False
+        self._flush_refs()
+        while self._released_threads:
+            L, ref, hooked = self._released_threads.pop()
+            if hooked:
+                lua54.lua_sethook(L, lua54.lua_Hook(), 0, 0)
+            self._release_thread(L, ref)
+
+    def reference_stats(self):
+        return {"live": self.live_references, "pending": len(self._released_refs), "released": self._released_total}
+
+    def call_threadsafe(self, name, *args):
+        # Calls global function name from any thread on the owner thread's event loop, returning a
+        # concurrent.futures.Future. Arguments and results are plain Python data, as with ProcessRuntime
+        if self.owner_loop is None:
+            raise RuntimeError("Runtime has no event loop to call on")
+        return asyncio.run_coroutine_threadsafe(self._call_plain(name, args), self.owner_loop)
+
+    async def _call_plain(self, name, args):
+        f = self.globals()[name]
+        if not isinstance(f, Function):
+            raise ValueError("%r is not a Lua function" % name)
+        return _to_wire(await f(*_from_wire(self, args)))
+
+    def _alloc(self, ud, ptr, osize, nsize):
+        # lua_Alloc: osize is only a size when ptr isn't NULL
+        old = osize if ptr else 0
+        if nsize == 0:
+            _mem_free(ptr)
+            self.memory_used -= old
+            return None
+
+        if self._memory_limit_active and self.memory_limit is not None and nsize > old and self.memory_used + nsize - old > self.memory_limit:
+            self._memory_failures += 1
+            return None
+
+        p = _mem_realloc(ptr, nsize)
+        if p:
+            self.memory_used += nsize - old
+            if self.memory_used > self.memory_peak:
+                self.memory_peak = self.memory_used
+        return p
+
+    @contextlib.contextmanager
+    def _memory_limited(self):
+        # For the calls besides lua_resume that can run script code (finalizers, __close handlers),
+        # all in protected mode so a failed allocation is reported as an error there
+        limit_active, self._memory_limit_active = self._memory_limit_active, True
+        try:
+            yield
+        finally:
+            self._memory_limit_active = limit_active
+
+    def memory_stats(self):
+        if self._allocator is None:
+            raise ValueError("Memory is only tracked for runtimes created with memory_limit or track_memory")
+        return {"used": self.memory_used, "peak": self.memory_peak, "limit": self.memory_limit, "failures": self._memory_failures}
+
+    def gc_incremental(self, pause=0, stepmul=0, stepsize=0):
+        # Switches to incremental collection, 0 leaves a parameter unchanged. Returns the previous mode
+        self._check_thread()
+        previous = lua54.lua_gc(self.L, lua54.LUA_GCINC, pause, stepmul, stepsize)
+        return "generational" if previous == lua54.LUA_GCGEN else "incremental"
+
+    def gc_generational(self, minormul=0, majormul=0):
+        self._check_thread()
+        previous = lua54.lua_gc(self.L, lua54.LUA_GCGEN, minormul, majormul, 0)
+        return "generational" if previous == lua54.LUA_GCGEN else "incremental"
+
+    def gc_step(self, kbytes=0):
+        # Returns True if the step finished a collection cycle
+        self._check_thread()
+        with self._memory_limited():
+            return lua54.lua_gc(self.L, lua54.LUA_GCSTEP, kbytes, 0, 0) == 1
+
+    def gc_collect(self):
+        self._check_thread()
+        with self._memory_limited():
+            lua54.lua_gc(self.L, lua54.LUA_GCCOLLECT, 0, 0, 0)
+
+    def heap_size(self):
+        self._check_thread()
+        return lua54.lua_gc(self.L, lua54.LUA_GCCOUNT, 0, 0, 0) * 1024 + lua54.lua_gc(self.L, lua54.LUA_GCCOUNTB, 0, 0, 0)
+
+    def enable_idle_gc(self, kbytes=0, interval=0.005, max_interval=1.0):
+        # Runs one bounded incremental step every interval in which no Lua coroutine was resumed, so
+        # collection work happens while the loop would otherwise be idle instead of mid-request.
+        # Once a cycle is finished it waits for a resume or a bigger heap, checking ever less often
+        # (up to every max_interval)
+        self._check_thread()
+        self.disable_idle_gc()
+        self._idle_gc_task = asyncio.get_running_loop().create_task(Runtime._idle_gc(weakref.ref(self), kbytes, interval, max_interval))
+
+    def disable_idle_gc(self):
+        if self._idle_gc_task is not None:
+            self._idle_gc_task.cancel()
+            self._idle_gc_task = None
+
+    @staticmethod
+    async def _idle_gc(runtime_ref, kbytes, interval, max_interval):
+        # Holds the runtime weakly so the task doesn't keep it alive
+        resumes = None
+        # Heap size when the last cycle finished, None while there's collecting left to do
+        collected_heap = None
+        delay = interval
+        while True:
+            await asyncio.sleep(delay)
+            runtime = runtime_ref()
+            if runtime is None:
+                return
+            if runtime._resume_count != resumes:
+                resumes = runtime._resume_count
+                collected_heap = None
+                delay = interval
+            elif collected_heap is not None and runtime.heap_size() <= collected_heap:
+                delay = min(delay * 2, max_interval)
+            elif runtime.gc_step(kbytes):
+                collected_heap = runtime.heap_size()
+            else:
+                collected_heap = None
+                delay = interval
+            runtime = None
+
+    def enable_metrics(self):
+        if self.metrics is None:
+            self.metrics = RuntimeMetrics()
+
+    def disable_metrics(self):
+        self.metrics = None
+
+    def metrics_snapshot(self):
+        if self.metrics is None:
+            raise ValueError("Metrics are not enabled")
+        snapshot = self.metrics.snapshot()
+        snapshot["threads"] = self.threads
+        snapshot["thread_pool"] = self.thread_pool_stats()
+        snapshot["references"] = self.reference_stats()
+        return snapshot
+
+    def add_metrics_exporter(self, exporter, interval=None):
+        # exporter(snapshot) is called by export_metrics(), and every interval seconds if given
+        self._metrics_exporters.append(exporter)
+        if interval is not None:
+            asyncio.get_running_loop().create_task(Runtime._export_periodically(weakref.ref(self), exporter, interval))
+
+    def remove_metrics_exporter(self, exporter):
+        self._metrics_exporters.remove(exporter)
+
+    def export_metrics(self):
+        snapshot = self.metrics_snapshot()
+        for exporter in list(self._metrics_exporters):
+            exporter(snapshot)
+
+    @staticmethod
+    async def _export_periodically(runtime_ref, exporter, interval):
+        while True:
+            await asyncio.sleep(interval)
+            runtime = runtime_ref()
+            if runtime is None or exporter not in runtime._metrics_exporters:
+                return
+            if runtime.metrics is not None:
+                exporter(runtime.metrics_snapshot())
+            runtime = None
+
+    def thread_pool_stats(self):
+        stats = dict(self._thread_pool_stats)
+        stats["idle"] = len(self._idle_threads)
+        stats["size"] = self.thread_pool_size
+        return stats
+
     def __del__(self):
+        if self._idle_gc_task is not None:
+            self._idle_gc_task.cancel()
         if self.threads > 0:
             # Interpreter exiting, cleanup doesn't matter
             return
         lua54.lua_close(self.L)
 
     def globals(self):
+        self._check_thread()
         try:
             lua54.lua_getglobal(self.dummy_coroutine.L, b"_G")
             t = Table(self.dummy_coroutine)
@@ -515,30 +1771,859 @@ class Runtime():
             print("OSError caught: stack top is", lua54.lua_gettop(self.dummy_coroutine.L))
             raise
 
-    def _function_callback_gen(self, f, name, nargs=None):
-        def cb(state):
-            cmd = name.encode(self.encoding)
-            # print(state)
-            # traceback.print_stack()
-            nargs_passed = lua54.lua_gettop(state)
-            # print(nargs_passed)
-            lua54.lua_pushlstring(state, cmd, len(cmd))
-            if nargs is None:
-                lua54.lua_pushinteger(state, nargs_passed)
+    def _new_command(self, f, name, nargs=None, sync=False):
+        # Pushes a Lua function calling command f onto the main thread's stack and returns its index
+        command_id = self._add_command(f, name, nargs)
+        lua54.lua_rawgeti(self.L, lua54.LUA_REGISTRYINDEX, self._command_wrapper_ref)
+        lua54.lua_pushinteger(self.L, command_id)
+        if sync:
+            lua54.lua_pushinteger(self.L, command_id)
+            lua54.lua_pushcclosure(self.L, self._sync_trampoline, 1)
+        else:
+            lua54.lua_pushnil(self.L)
+        try:
+            self._call_helper(2, 1)
+        except LuaRuntimeError:
+            self.callbacks[command_id] = None
+            self._free_command_ids.append(command_id)
+            raise
+        return command_id
+
+    def _add_command(self, f, name, nargs=None):
+        if self._free_command_ids:
+            command_id = self._free_command_ids.pop()
+            self.callbacks[command_id] = (f, name, nargs)
+            return command_id
+        self.callbacks.append((f, name, nargs))
+        return len(self.callbacks) - 1
+
+    def _push_callable(self, f):
+        # Pushes the Lua wrapper of a Python callable onto the main thread's stack, reusing the
+        # existing one (and its command index) if Lua still holds it
+        try:
+            command_id = self._interned_callables.get(f)
+            hashable = True
+        except TypeError:
+            command_id = None
+            hashable = False
+
+        if command_id is None:
+            command_id = self._add_command(f, "@CB" + str(id(f)))
+            self._callable_refs[command_id] = 0
+            if hashable:
+                self._interned_callables[f] = command_id
+
+        lua54.lua_rawgeti(self.L, lua54.LUA_REGISTRYINDEX, self._callable_interner_ref)
+        lua54.lua_pushinteger(self.L, command_id)
+        # On failure (out of memory) a new entry is left at 0 references: a sentinel may already
+        # exist, its __gc then frees the entry
+        self._call_helper(1, 2)
+        if lua54.lua_toboolean(self.L, -1):
+            self._callable_refs[command_id] += 1
+        lua54.lua_pop(self.L, 1)
+
+    def _push_proxy(self, obj):
+        # Pushes the userdata proxy for obj onto the main thread's stack
+        proxy_id = self._proxy_ids.get(id(obj))
+        if proxy_id is None:
+            proxy_id = next(self._next_proxy_id)
+            self._proxies[proxy_id] = obj
+            self._proxy_ids[id(obj)] = proxy_id
+            self._proxy_refs[proxy_id] = 0
+
+        if self._proxy_interner_ref is None:
+            self._init_proxies()
+        lua54.lua_rawgeti(self.L, lua54.LUA_REGISTRYINDEX, self._proxy_interner_ref)
+        lua54.lua_pushinteger(self.L, proxy_id)
+        # Same as in _push_callable, a userdata left behind by a failed call frees the entry
+        self._call_helper(1, 2)
+        if lua54.lua_toboolean(self.L, -1):
+            self._proxy_refs[proxy_id] += 1
+        lua54.lua_pop(self.L, 1)
+
+    def _is_proxy(self, L, idx):
+        if self._proxy_metatable_ref is None or not lua54.lua_getmetatable(L, idx):
+            return False
+        lua54.lua_rawgeti(L, lua54.LUA_REGISTRYINDEX, self._proxy_metatable_ref)
+        r = lua54.lua_rawequal(L, -1, -2)
+        lua54.lua_pop(L, 2)
+        return r == 1
+
+    def _new_proxy(self, state):
+        proxy_id = lua54.lua_tointegerx(state, 1, None)
+        ctypes.c_longlong.from_address(lua54.lua_newuserdatauv(state, 8, 0)).value = proxy_id
+        # Lua's setmetatable only takes tables
+        lua54.lua_rawgeti(state, lua54.LUA_REGISTRYINDEX, self._proxy_metatable_ref)
+        lua54.lua_setmetatable(state, -2)
+        return 1
+
+    def _release_proxy(self, state):
+        # __gc of a proxy
+        proxy_id = ctypes.c_longlong.from_address(lua54.lua_touserdata(state, 1)).value
+        self._proxy_refs[proxy_id] -= 1
+        if self._proxy_refs[proxy_id] <= 0:
+            del self._proxy_refs[proxy_id]
+            del self._proxy_ids[id(self._proxies.pop(proxy_id))]
+        return 0
+
+    def _proxy_callback(self, handler):
+        # Wraps handler(obj, *args) with the same status flag protocol as sync commands
+        def callback(state):
+            proxy_id = ctypes.c_longlong.from_address(lua54.lua_touserdata(state, 1)).value
+            limit_active, self._memory_limit_active = self._memory_limit_active, False
+            try:
+                return self._call_with_status(state, 2, lambda args: handler(self._proxies[proxy_id], *args), Coroutine._push_proxy_result)
+            finally:
+                self._memory_limit_active = limit_active
+        return callback
+
+    @staticmethod
+    def _proxy_index(obj, key):
+        if isinstance(obj, collections.abc.Mapping):
+            return obj.get(key)
+        elif isinstance(obj, collections.abc.Sequence) and not isinstance(obj, (str, bytes)):
+            if isinstance(key, int) and 1 <= key <= len(obj):
+                return obj[key - 1]
+            return None
+        elif isinstance(key, str) and not key.startswith("_"):
+            return getattr(obj, key, None)
+        return None
+
+    @staticmethod
+    def _proxy_newindex(obj, key, value):
+        if isinstance(obj, collections.abc.MutableMapping):
+            obj[key] = value
+        elif isinstance(obj, collections.abc.MutableSequence):
+            if not isinstance(key, int) or not 1 <= key <= len(obj) + 1:
+                raise IndexError("index %r out of range" % key)
+            if key == len(obj) + 1:
+                obj.append(value)
             else:
-                lua54.lua_pushinteger(state, nargs)
-            # self.function_to_call = callback
-            return lua54.lua_yieldk(state, lua54.lua_gettop(state), 0, None)
-        
-        self.callbacks[name] = f
-        return cb
+                obj[key - 1] = value
+        elif isinstance(key, str) and not key.startswith("_"):
+            setattr(obj, key, value)
+        else:
+            raise AttributeError("cannot set %r" % key)
+
+    @staticmethod
+    def _proxy_call(obj, *args):
+        result = obj(*args)
+        if inspect.isawaitable(result):
+            if inspect.iscoroutine(result):
+                result.close()
+            raise TypeError("async callables can't be called through a proxy, pass them to Lua directly")
+        return result
+
+    def _release_callable(self, state):
+        # Called from the __gc of a wrapper's sentinel
+        command_id = lua54.lua_tointegerx(state, 1, None)
+        self._callable_refs[command_id] -= 1
+        if self._callable_refs[command_id] > 0:
+            return 0
+
+        del self._callable_refs[command_id]
+        f = self.callbacks[command_id][0]
+        try:
+            if self._interned_callables.get(f) == command_id:
+                del self._interned_callables[f]
+        except TypeError:
+            pass
+        self.callbacks[command_id] = None
+        self._free_command_ids.append(command_id)
+        return 0
+
+    def _sync_command_callback(self, state):
+        # The memory limit is lifted while Python pushes the results
+        limit_active, self._memory_limit_active = self._memory_limit_active, False
+        try:
+            if self.metrics is None:
+                return self._run_sync_command(state)
+            start = time.perf_counter()
+            name = self.callbacks[lua54.lua_tointegerx(state, lua_upvalueindex(1), None)][1]
+            n = self._run_sync_command(state)
+            self.metrics.command(name, time.perf_counter() - start, not lua54.lua_toboolean(state, 1))
+            return n
+        finally:
+            self._memory_limit_active = limit_active
+
+    def _run_sync_command(self, state):
+        # Runs a sync command inline inside the C call, no yield back to Coroutine.__anext__
+        f, name, nargs = self.callbacks[lua54.lua_tointegerx(state, lua_upvalueindex(1), None)]
+
+        def call(args):
+            if nargs is not None and nargs != len(args):
+                raise ValueError("Command %r expected %d arguments, got %d" % (name, nargs, len(args)))
+            return f(self, *args)
+
+        return self._call_with_status(state, 1, call, Coroutine._push_python_object)
+
+    def _call_with_status(self, state, first_arg, call, push):
+        # Body of the C functions Lua calls into: passes the arguments from first_arg on to call and
+        # returns true and its results (pushed with push), or false and the message if it raised.
+        # Errors can't be raised with lua_error here (longjmp-ing over the Python frame corrupts the
+        # interpreter), the Lua side check() in _STATUS_CHECK raises them instead
+        thread = self._thread_objects.get(state, self)
+        try:
+            args = [Coroutine._to_python_type(thread, i) for i in range(first_arg, lua54.lua_gettop(state) + 1)]
+            lua54.lua_settop(state, 0)
+            results = call(args)
+
+            lua54.lua_pushboolean(state, 1)
+            if isinstance(results, tuple):
+                for i in results:
+                    push(thread, i)
+                return len(results) + 1
+            push(thread, results)
+            return 2
+        except Exception as e:
+            msg = ("%s: %s" % (type(e).__name__, e)).encode(self.encoding, "replace")
+            lua54.lua_settop(state, 0)
+            lua54.lua_pushboolean(state, 0)
+            lua54.lua_pushlstring(state, msg, len(msg))
+            return 2
     
-    def register_command(self, callback, name, nargs=None):
-        self._register(name.encode(self.encoding), self._function_callback_gen(callback, name, nargs))
+    def register_command(self, callback, name, nargs=None, sync=False):
+        self._check_thread()
+        self._new_command(callback, name, nargs, sync)
+        lua54.lua_setglobal(self.L, name.encode(self.encoding))
+
+    def snapshot_globals(self):
+        # Records the global environment (every table reachable from _G, with contents and metatables)
+        # for restore_globals. Closures' upvalues aren't part of the snapshot
+        self._check_thread()
+        if self._globals_snapshot_ref is None:
+            lua54.luaopen_debug(self.L)
+            lua54.lua_getfield(self.L, -1, b"getmetatable")
+            lua54.lua_getfield(self.L, -2, b"setmetatable")
+            lua54.lua_remove(self.L, -3)
+            self._globals_snapshot_ref = self._load_helper(_GLOBALS_SNAPSHOT, 2)
+        else:
+            lua54.luaL_unref(self.L, lua54.LUA_REGISTRYINDEX, self._globals_restore_ref)
+
+        lua54.lua_rawgeti(self.L, lua54.LUA_REGISTRYINDEX, self._globals_snapshot_ref)
+        lua54.lua_rawgeti(self.L, lua54.LUA_REGISTRYINDEX, lua54.LUA_RIDX_GLOBALS)
+        self._call_helper(1, 1)
+        self._globals_restore_ref = lua54.luaL_ref(self.L, lua54.LUA_REGISTRYINDEX)
+
+    def restore_globals(self):
+        self._check_thread()
+        lua54.lua_rawgeti(self.L, lua54.LUA_REGISTRYINDEX, self._globals_restore_ref)
+        self._call_helper(0, 0)
+
+    def _call_helper(self, nargs, nresults):
+        if lua54.lua_pcallk(self.L, nargs, nresults, 0, 0, None) != lua54.LUA_OK:
+            err = lua54.lua_tolstring(self.L, -1, None).decode(self.encoding)
+            lua54.lua_pop(self.L, 1)
+            raise LuaRuntimeError(err)
+
+    def enable_scheduler(self, name="tasks"):
+        # Installs the built-in task scheduler as the global table `name`
+        self._check_thread()
+        if self.scheduler is None:
+            self.scheduler = Scheduler(self, name)
+        return self.scheduler
 
     def __iter__(self):
         return self
 
+class _SchedulerTask():
+
+    def __init__(self, task_id, coro):
+        self.id = task_id
+        self.coro = coro
+        self.done = False
+        self.results = None
+        self.error = None
+        # (task, [active]) pairs of tasks blocked in join/select on this one; select registers the same
+        # list with every task it waits for and clears it once the first one fires
+        self.waiters = []
+        self.future = None
+
+class Scheduler():
+    # Runs many Lua tasks as threads multiplexed over a single driver coroutine. Sleeping tasks wait in
+    # a heap with one timer handle for the earliest deadline, only tasks awaiting a regular async
+    # command get an asyncio future of their own. Lua sees spawn/sleep/join/select/done in a table
+
+    def __init__(self, runtime, name="tasks"):
+        self.runtime = runtime
+        self.tasks = {}
+        self._task_ids = itertools.count(1)
+        self._ready = collections.deque()
+        self._sleepers = []
+        self._sleeper_seq = itertools.count()
+        self._pending = 0
+        self._driver = None
+        self._waiter = None
+
+        L = runtime.L
+        lua54.lua_createtable(L, 0, 5)
+        self._native = {}
+        for cmd, f, sync, native in (
+            ("spawn", self._lua_spawn, True, None),
+            ("done", self._lua_done, True, None),
+            ("sleep", self._lua_sleep, False, self._sched_sleep),
+            ("join", self._lua_join, False, self._sched_join),
+            ("select", self._lua_select, False, self._sched_select),
+        ):
+            command_id = runtime._new_command(f, name + "." + cmd, None, sync)
+            if native is not None:
+                self._native[command_id] = native
+            lua54.lua_setfield(L, -2, cmd.encode("ascii"))
+        lua54.lua_setglobal(L, name.encode(runtime.encoding))
+
+    def spawn(self, f, *args):
+        coro = Coroutine(self.runtime, args)
+        lua54.lua_rawgeti(coro.L, lua54.LUA_REGISTRYINDEX, f.ref)
+        task = _SchedulerTask(next(self._task_ids), coro)
+        self.tasks[task.id] = task
+        self._ready.append((task, None, None))
+        self._wake()
+        return task.id
+
+    def done(self, task_id):
+        task = self.tasks.get(task_id)
+        return task is None or task.done
+
+    async def join(self, task_id):
+        # Waits for a task and returns its results, the task is forgotten afterwards
+        task = self.tasks[task_id]
+        if not task.done:
+            if task.future is None:
+                task.future = asyncio.get_running_loop().create_future()
+            await asyncio.shield(task.future)
+        # Lua joiners may already have removed it
+        self.tasks.pop(task_id, None)
+        if task.error is not None:
+            raise task.error
+        return task.results
+
+    async def select(self, *task_ids):
+        # Waits until one of the tasks is done and returns its id
+        if not task_ids:
+            raise ValueError("select needs at least one task")
+        for task_id in task_ids:
+            if self.tasks[task_id].done:
+                return task_id
+
+        loop = asyncio.get_running_loop()
+        for task_id in task_ids:
+            task = self.tasks[task_id]
+            if task.future is None:
+                task.future = loop.create_future()
+        futures = {asyncio.shield(self.tasks[task_id].future): task_id for task_id in task_ids}
+        done, pending = await asyncio.wait(futures, return_when=asyncio.FIRST_COMPLETED)
+        for future in pending:
+            future.cancel()
+        return futures[done.pop()]
+
+    def _lua_spawn(self, runtime, f, *args):
+        return self.spawn(f, *args)
+
+    def _lua_done(self, runtime, task_id):
+        return self.done(task_id)
+
+    # Used when the commands are called from coroutines not driven by the scheduler
+
+    async def _lua_sleep(self, runtime, seconds=0):
+        await asyncio.sleep(seconds)
+
+    async def _lua_join(self, runtime, task_id):
+        try:
+            return await self.join(task_id)
+        except KeyError:
+            raise LuaCommandError("unknown task %r" % task_id) from None
+        except Exception as e:
+            raise LuaCommandError(str(e)) from None
+
+    async def _lua_select(self, runtime, *task_ids):
+        try:
+            return await self.select(*task_ids)
+        except KeyError as e:
+            raise LuaCommandError("unknown task %r" % e.args[0]) from None
+        except Exception as e:
+            raise LuaCommandError(str(e)) from None
+
+    # Native versions used when running under the scheduler, these never block
+
+    def _sched_sleep(self, task, seconds=0):
+        deadline = asyncio.get_running_loop().time() + seconds
+        heapq.heappush(self._sleepers, (deadline, next(self._sleeper_seq), task))
+
+    def _sched_join(self, task, task_id):
+        target = self.tasks.get(task_id)
+        if target is None:
+            self._ready.append((task, None, "unknown task %r" % task_id))
+        elif target.done:
+            self.tasks.pop(task_id, None)
+            self._ready.append((task, target.results, None if target.error is None else str(target.error)))
+        else:
+            target.waiters.append(("join", task, [True]))
+
+    def _sched_select(self, task, *task_ids):
+        if not task_ids:
+            self._ready.append((task, None, "select needs at least one task"))
+            return
+        for task_id in task_ids:
+            target = self.tasks.get(task_id)
+            if target is None:
+                self._ready.append((task, None, "unknown task %r" % task_id))
+                return
+            if target.done:
+                self._ready.append((task, task_id, None))
+                return
+
+        active = [True]
+        for task_id in task_ids:
+            self.tasks[task_id].waiters.append(("select", task, active))
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+        if self._driver is None:
+            self._driver = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._ready or self._sleepers or self._pending:
+                now = loop.time()
+                while self._sleepers and self._sleepers[0][0] <= now:
+                    self._ready.append((heapq.heappop(self._sleepers)[2], None, None))
+
+                if self._ready:
+                    for _ in range(len(self._ready)):
+                        entry = self._ready.popleft()
+                        try:
+                            self._step(*entry)
+                        except Exception as e:
+                            # A bug handling one task mustn't stop the driver for all the others
+                            if not entry[0].done:
+                                self._finish(entry[0], None, e)
+                    await asyncio.sleep(0)
+                    continue
+
+                self._waiter = loop.create_future()
+                handle = None
+                if self._sleepers:
+                    handle = loop.call_at(self._sleepers[0][0], self._wake)
+                try:
+                    await self._waiter
+                finally:
+                    self._waiter = None
+                    if handle is not None:
+                        handle.cancel()
+        finally:
+            self._driver = None
+
+    def _step(self, task, results, error):
+        coro = task.coro
+        coro.callback_results = results
+        coro.callback_error = error
+        try:
+            command = coro._resume()
+        except StopAsyncIteration:
+            self._finish(task, coro.return_value, None)
+            return
+        except Exception as e:
+            self._finish(task, None, e)
+            return
+
+        if command is None:
+            self._ready.append((task, None, None))
+            return
+
+        command_id, args = command
+        native = self._native.get(command_id)
+        if native is not None:
+            try:
+                native(task, *args)
+            except Exception as e:
+                self._ready.append((task, None, "%s: %s" % (type(e).__name__, e)))
+            return
+
+        self._pending += 1
+        start = None if self.runtime.metrics is None else time.perf_counter()
+        future = asyncio.ensure_future(self.runtime.callbacks[command_id][0](self.runtime, *args))
+        future.add_done_callback(lambda future: self._command_done(task, future, command_id, start))
+
+    def _command_done(self, task, future, command_id, start):
+        self._pending -= 1
+        if start is not None and self.runtime.metrics is not None:
+            failed = future.cancelled() or future.exception() is not None
+            self.runtime.metrics.command(self.runtime.callbacks[command_id][1], time.perf_counter() - start, failed)
+        if future.cancelled():
+            self._ready.append((task, None, "command cancelled"))
+        elif future.exception() is not None:
+            e = future.exception()
+            self._ready.append((task, None, "%s: %s" % (type(e).__name__, e)))
+        else:
+            self._ready.append((task, future.result(), None))
+        self._wake()
+
+    def _finish(self, task, results, error):
+        task.done = True
+        task.results = results
+        task.error = error
+        task.coro = None
+        joined = False
+        for kind, waiter, active in task.waiters:
+            if not active[0]:
+                continue
+            active[0] = False
+            if kind == "join":
+                joined = True
+                self._ready.append((waiter, results, None if error is None else str(error)))
+            else:
+                self._ready.append((waiter, task.id, None))
+        task.waiters = []
+        if joined:
+            # Forgotten once every joiner has its results
+            self.tasks.pop(task.id, None)
+        if task.future is not None and not task.future.done():
+            task.future.set_result(None)
+
+class RuntimePool():
+    # Keeps runtimes that already ran the top-level chunk and setup(runtime) (typically registering
+    # commands) ready for use. Released runtimes get their globals restored to how they were right
+    # after setup and are handed out again, until they've been used max_uses times or sat idle for
+    # longer than max_idle seconds
+
+    def __init__(self, code, setup=None, max_size=8, max_idle=300, max_uses=1000, **runtime_args):
+        self.code = code
+        self.setup = setup
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        self.runtime_args = runtime_args
+        self._idle = collections.deque()
+        self._uses = weakref.WeakKeyDictionary()
+        self._stats = {"created": 0, "reused": 0, "recycled": 0, "discarded": 0}
+
+    def _new_runtime(self):
+        rt = Runtime(self.code, **self.runtime_args)
+        if self.setup is not None:
+            self.setup(rt)
+        rt.snapshot_globals()
+        self._uses[rt] = 0
+        self._stats["created"] += 1
+        return rt
+
+    def fill(self, n=None):
+        # Creates runtimes ahead of time, up to n idle ones (max_size by default)
+        n = self.max_size if n is None else min(n, self.max_size)
+        while len(self._idle) < n:
+            self._idle.append((self._new_runtime(), time.monotonic()))
+
+    def _reap_idle(self):
+        # Idle runtimes are appended as they're released, so the expired ones are all on the left
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][1] > self.max_idle:
+            self._idle.popleft()
+            self._stats["discarded"] += 1
+
+    def acquire(self):
+        self._reap_idle()
+        if self._idle:
+            self._stats["reused"] += 1
+            return self._idle.pop()[0]
+        return self._new_runtime()
+
+    def release(self, rt):
+        self._reap_idle()
+        self._uses[rt] += 1
+        scheduler_busy = rt.scheduler is not None and rt.scheduler.tasks
+        if self._uses[rt] >= self.max_uses or len(self._idle) >= self.max_size or scheduler_busy:
+            self._stats["discarded"] += 1
+            return
+
+        try:
+            rt.restore_globals()
+        except LuaRuntimeError:
+            self._stats["discarded"] += 1
+            return
+        self._stats["recycled"] += 1
+        self._idle.append((rt, time.monotonic()))
+
+    @contextlib.contextmanager
+    def runtime(self):
+        rt = self.acquire()
+        try:
+            yield rt
+        finally:
+            self.release(rt)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["idle"] = len(self._idle)
+        return stats
+
+def _to_wire(value):
+    # Plain Python data that marshal can send between processes
+    if isinstance(value, Table):
+        return value.to_python()
+    elif isinstance(value, tuple):
+        return tuple(_to_wire(i) for i in value)
+    elif isinstance(value, list):
+        return [_to_wire(i) for i in value]
+    elif isinstance(value, memoryview):
+        return value.tobytes()
+    return value
+
+def _from_wire(runtime, value):
+    if isinstance(value, tuple):
+        return tuple(_from_wire(runtime, i) for i in value)
+    elif isinstance(value, (dict, list)):
+        return Table.from_python(runtime, value)
+    return value
+
+class _ProcessWorker():
+    # Runs in the worker process, owns the Runtime and serves calls coming through the pipe
+
+    def __init__(self, conn, code, setup, runtime_args):
+        self.conn = conn
+        self.runtime = Runtime(code, **runtime_args)
+        if setup is not None:
+            setup(self.runtime)
+        self._pending = {}
+        self._command_ids = itertools.count()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = self.loop.create_future()
+        threading.Thread(target=self._reader, daemon=True).start()
+        await self.stopped
+
+    def _reader(self):
+        while True:
+            try:
+                data = self.conn.recv_bytes()
+            except (EOFError, OSError):
+                data = None
+            self.loop.call_soon_threadsafe(self._dispatch, data)
+            if data is None:
+                return
+
+    def _dispatch(self, data):
+        msg = ("stop",) if data is None else marshal.loads(data)
+        if msg[0] == "call":
+            self.loop.create_task(self._call(*msg[1:]))
+        elif msg[0] == "result":
+            self._pending.pop(msg[1]).set_result(msg[2:])
+        elif msg[0] == "register":
+            _, name, nargs, sync, callback = msg
+            if callback is None:
+                self.runtime.register_command(self._forwarder(name), name, nargs)
+            else:
+                self.runtime.register_command(pickle.loads(callback), name, nargs, sync)
+        elif msg[0] == "stop" and not self.stopped.done():
+            self.stopped.set_result(None)
+
+    async def _call(self, call_id, name, args):
+        try:
+            result = await self.runtime._call_plain(name, args)
+            data = marshal.dumps(("done", call_id, True, result))
+        except Exception as e:
+            data = marshal.dumps(("done", call_id, False, "%s: %s" % (type(e).__name__, e)))
+        self.conn.send_bytes(data)
+
+    def _forwarder(self, name):
+        async def forward(runtime, *args):
+            command_id = next(self._command_ids)
+            self._pending[command_id] = self.loop.create_future()
+            self.conn.send_bytes(marshal.dumps(("command", command_id, name, _to_wire(args))))
+            ok, value = await self._pending[command_id]
+            if not ok:
+                raise LuaCommandError(value)
+            return _from_wire(runtime, value)
+        return forward
+
+def _process_worker_main(conn, code, setup, runtime_args):
+    asyncio.run(_ProcessWorker(conn, code, setup, runtime_args).run())
+
+class _ProcessWorkerHandle():
+
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.calls = set()
+
+class _RemoteFunction():
+
+    def __init__(self, runtime, name):
+        self.runtime = runtime
+        self.name = name
+
+    async def __call__(self, *args):
+        return await self.runtime.call(self.name, *args)
+
+class _RemoteGlobals():
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def __getitem__(self, name):
+        return _RemoteFunction(self.runtime, name)
+
+class ThreadRuntime():
+    # A Runtime living on its own thread with its own event loop, usable from any thread or loop
+    # through the same interface as ProcessRuntime. Commands run on the runtime's thread
+
+    def __init__(self, code, setup=None, **runtime_args):
+        self._ready = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._main, args=(code, setup, runtime_args), daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    def _main(self, code, setup, runtime_args):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.runtime = Runtime(code, **runtime_args)
+            self.runtime.owner_loop = self.loop
+            if setup is not None:
+                setup(self.runtime)
+        except Exception as e:
+            self._error = e
+            return
+        finally:
+            self._ready.set()
+
+        self.loop.run_forever()
+        self.runtime = None
+        self.loop.close()
+
+    def register_command(self, callback, name, nargs=None, sync=False):
+        self.loop.call_soon_threadsafe(self.runtime.register_command, callback, name, nargs, sync)
+
+    def globals(self):
+        return _RemoteGlobals(self)
+
+    async def call(self, name, *args):
+        return await asyncio.wrap_future(self.runtime.call_threadsafe(name, *args))
+
+    def close(self):
+        if self._thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+
+class ProcessRuntime():
+    # Same shape as Runtime (globals()[name](...), register_command), but every call runs in one of
+    # `workers` processes, each with a Runtime of its own, picked by the fewest calls in flight.
+    # Arguments and results are plain data (tables arrive as dicts) marshalled over pipes.
+    # Commands run in this process by default; with forward=False the (picklable) callback is
+    # sent to the workers and runs there instead
+
+    def __init__(self, code, workers=None, setup=None, mp_context=None, **runtime_args):
+        self.code = code
+        self.setup = setup
+        self.runtime_args = runtime_args
+        self.worker_count = workers or os.cpu_count() or 1
+        self._mp = mp_context or multiprocessing.get_context()
+        self._workers = []
+        self._registrations = []
+        self._commands = {}
+        self._calls = {}
+        self._call_ids = itertools.count()
+        self._loop = None
+
+    def register_command(self, callback, name, nargs=None, sync=False, forward=True):
+        if forward:
+            self._commands[name] = callback
+            msg = ("register", name, nargs, sync, None)
+        else:
+            msg = ("register", name, nargs, sync, pickle.dumps(callback))
+        self._registrations.append(msg)
+        for worker in self._workers:
+            worker.conn.send_bytes(marshal.dumps(msg))
+
+    def globals(self):
+        return _RemoteGlobals(self)
+
+    def _start(self):
+        self._loop = asyncio.get_running_loop()
+        for _ in range(self.worker_count):
+            conn, child_conn = self._mp.Pipe()
+            process = self._mp.Process(target=_process_worker_main, args=(child_conn, self.code, self.setup, self.runtime_args), daemon=True)
+            process.start()
+            child_conn.close()
+            worker = _ProcessWorkerHandle(process, conn)
+            for msg in self._registrations:
+                conn.send_bytes(marshal.dumps(msg))
+            threading.Thread(target=self._reader, args=(worker,), daemon=True).start()
+            self._workers.append(worker)
+
+    def _reader(self, worker):
+        while True:
+            try:
+                data = worker.conn.recv_bytes()
+            except (EOFError, OSError):
+                data = None
+            self._loop.call_soon_threadsafe(self._dispatch, worker, data)
+            if data is None:
+                return
+
+    def _dispatch(self, worker, data):
+        if data is None:
+            for call_id in worker.calls:
+                future = self._calls.pop(call_id)
+                if not future.done():
+                    future.set_exception(RuntimeError("Worker process exited"))
+            worker.calls.clear()
+            if worker in self._workers:
+                self._workers.remove(worker)
+            return
+
+        msg = marshal.loads(data)
+        if msg[0] == "done":
+            _, call_id, ok, value = msg
+            worker.calls.discard(call_id)
+            future = self._calls.pop(call_id)
+            if future.done():
+                return
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(LuaRuntimeError(value))
+        elif msg[0] == "command":
+            self._loop.create_task(self._run_command(worker, *msg[1:]))
+
+    async def _run_command(self, worker, command_id, name, args):
+        try:
+            result = self._commands[name](self, *args)
+            if inspect.isawaitable(result):
+                result = await result
+            data = marshal.dumps(("result", command_id, True, _to_wire(result)))
+        except Exception as e:
+            data = marshal.dumps(("result", command_id, False, "%s: %s" % (type(e).__name__, e)))
+        worker.conn.send_bytes(data)
+
+    async def call(self, name, *args):
+        if not self._workers:
+            if self._loop is not None:
+                raise RuntimeError("All worker processes have exited")
+            self._start()
+
+        worker = min(self._workers, key=lambda worker: len(worker.calls))
+        call_id = next(self._call_ids)
+        future = self._calls[call_id] = self._loop.create_future()
+        worker.calls.add(call_id)
+        worker.conn.send_bytes(marshal.dumps(("call", call_id, name, _to_wire(args))))
+        return await future
+
+    def close(self):
+        for worker in self._workers:
+            try:
+                worker.conn.send_bytes(marshal.dumps(("stop",)))
+            except OSError:
+                pass
+        for worker in self._workers:
+            worker.process.join(5)
+            worker.conn.close()
+        self._workers = []
+
 c_void   = None
 size_t   = ctypes.c_longlong
 size_t_p = ctypes.POINTER(size_t) 
@@ -549,6 +2634,7 @@ else:
     lua54 = Lib(os.path.join(os.path.dirname(os.path.abspath(__file__)), "lua", "liblua.so"))
 
 lua54.LUA_REGISTRYINDEX  = -1001000
+lua54.LUA_RIDX_GLOBALS   = 2
 lua54.LUA_OPEQ           = 0
 lua54.LUA_OPLT           = 1
 lua54.LUA_OPLE           = 2
@@ -570,19 +2656,62 @@ lua54.LUA_TTHREAD        = 8
 lua54.LUA_NUMTYPES       = 9
 lua54.lua_State_p        = ctypes.c_void_p                                    # Either an interpreter state or a thread object.
 lua54.lua_CFunction      = ctypes.CFUNCTYPE(ctypes.c_int, lua54.lua_State_p)  # Pointer to a function that can be registered with lua_register
+lua54.lua_Writer         = ctypes.CFUNCTYPE(ctypes.c_int, lua54.lua_State_p, ctypes.c_void_p, size_t, ctypes.c_void_p)
+lua54.lua_Alloc          = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, size_t, size_t)
+lua54.LUA_IDSIZE         = 60
+lua54.lua_Debug          = type("lua_Debug", (ctypes.Structure, ), {"_fields_": [  # struct lua_Debug of Lua 5.4
+    ("event", ctypes.c_int),
+    ("name", ctypes.c_char_p),
+    ("namewhat", ctypes.c_char_p),
+    ("what", ctypes.c_char_p),
+    ("source", ctypes.c_char_p),
+    ("srclen", size_t),
+    ("currentline", ctypes.c_int),
+    ("linedefined", ctypes.c_int),
+    ("lastlinedefined", ctypes.c_int),
+    ("nups", ctypes.c_ubyte),
+    ("nparams", ctypes.c_ubyte),
+    ("isvararg", ctypes.c_char),
+    ("istailcall", ctypes.c_char),
+    ("ftransfer", ctypes.c_ushort),
+    ("ntransfer", ctypes.c_ushort),
+    ("short_src", ctypes.c_char * lua54.LUA_IDSIZE),
+    ("i_ci", ctypes.c_void_p),
+]})
+lua54.lua_Hook           = ctypes.CFUNCTYPE(None, lua54.lua_State_p, ctypes.c_void_p)
+lua54.LUA_GCSTOP         = 0
+lua54.LUA_GCRESTART      = 1
+lua54.LUA_GCCOLLECT      = 2
+lua54.LUA_GCCOUNT        = 3
+lua54.LUA_GCCOUNTB       = 4
+lua54.LUA_GCSTEP         = 5
+lua54.LUA_GCISRUNNING    = 9
+lua54.LUA_GCGEN          = 10
+lua54.LUA_GCINC          = 11
+lua54.LUA_MASKCALL       = 1 << 0
+lua54.LUA_MASKRET        = 1 << 1
+lua54.LUA_MASKLINE       = 1 << 2
+lua54.LUA_MASKCOUNT      = 1 << 3
 
 lua54.lua_yieldk       .decl(ctypes.c_int,       (lua54.lua_State_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p))
 lua54.lua_settop       .decl(c_void,             (lua54.lua_State_p, ctypes.c_int))
 lua54.luaL_newstate    .decl(lua54.lua_State_p,  ())
+lua54.lua_gc           .decl(ctypes.c_int,       (lua54.lua_State_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int))  # Variadic, extra arguments are ignored
+lua54.lua_newuserdatauv.decl(ctypes.c_void_p,    (lua54.lua_State_p, size_t, ctypes.c_int))
+lua54.lua_touserdata   .decl(ctypes.c_void_p,    (lua54.lua_State_p, ctypes.c_int))
+lua54.lua_getmetatable .decl(ctypes.c_int,       (lua54.lua_State_p, ctypes.c_int))
+lua54.lua_getstack     .decl(ctypes.c_int,       (lua54.lua_State_p, ctypes.c_int, ctypes.c_void_p))
+lua54.lua_getinfo      .decl(ctypes.c_int,       (lua54.lua_State_p, ctypes.c_char_p, ctypes.c_void_p))
+lua54.lua_newstate     .decl(lua54.lua_State_p,  (lua54.lua_Alloc, ctypes.c_void_p))
 lua54.lua_pushcclosure .decl(c_void,             (lua54.lua_State_p, lua54.lua_CFunction, ctypes.c_void_p))
 lua54.lua_setglobal    .decl(c_void,             (lua54.lua_State_p, ctypes.c_char_p))
 lua54.lua_pushlstring  .decl(c_void,             (lua54.lua_State_p, ctypes.c_char_p, size_t))
-lua54.luaL_loadstring  .decl(ctypes.c_int,       (lua54.lua_State_p, ctypes.c_char_p))
-lua54.lua_pcallk       .decl(ctypes.c_int,       (lua54.lua_State_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_void_p))
+lua54.luaL_loadstring  .decl(ctypes.c_int,       (lua54.lua_State_p, ctypes.c_char_p), release_gil=True)
+lua54.lua_pcallk       .decl(ctypes.c_int,       (lua54.lua_State_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_void_p), release_gil=True)
 lua54.lua_tolstring    .decl(ctypes.c_char_p,    (lua54.lua_State_p, ctypes.c_int, size_t_p))
 lua54.lua_tonumberx    .decl(ctypes.c_double,    (lua54.lua_State_p, ctypes.c_int, ctypes.POINTER(ctypes.c_int)))
 lua54.lua_getglobal    .decl(ctypes.c_int,       (lua54.lua_State_p, ctypes.c_char_p))
-lua54.lua_resume       .decl(ctypes.c_int,       (lua54.lua_State_p, lua54.lua_State_p, ctypes.c_int, ctypes.POINTER(ctypes.c_int)))
+lua54.lua_resume       .decl(ctypes.c_int,       (lua54.lua_State_p, lua54.lua_State_p, ctypes.c_int, ctypes.POINTER(ctypes.c_int)), release_gil=True)
 lua54.lua_isstring     .decl(ctypes.c_int,       (lua54.lua_State_p, ctypes.c_int))
 lua54.lua_close        .decl(c_void,             (lua54.lua_State_p, ))
 lua54.lua_pushinteger  .decl(c_void,             (lua54.lua_State_p, ctypes.c_longlong))
@@ -606,13 +2735,60 @@ lua54.lua_pushthread   .decl(ctypes.c_int,       (lua54.lua_State_p, lua54.lua_S
 lua54.lua_xmove        .decl(c_void,             (lua54.lua_State_p, lua54.lua_State_p, ctypes.c_int))
 lua54.lua_createtable  .decl(c_void,             (lua54.lua_State_p, ctypes.c_int, ctypes.c_int))
 lua54.lua_settable     .decl(c_void,             (lua54.lua_State_p, ctypes.c_int))
-lua54.luaL_loadbufferx .decl(ctypes.c_int,       (lua54.lua_State_p, ctypes.c_char_p, size_t, ctypes.c_char_p, ctypes.c_char_p))
+lua54.luaL_loadbufferx .decl(ctypes.c_int,       (lua54.lua_State_p, ctypes.c_char_p, size_t, ctypes.c_char_p, ctypes.c_char_p), release_gil=True)
+lua54.lua_dump         .decl(ctypes.c_int,       (lua54.lua_State_p, lua54.lua_Writer, ctypes.c_void_p, ctypes.c_int))
+lua54.lua_setfield     .decl(c_void,             (lua54.lua_State_p, ctypes.c_int, ctypes.c_char_p))
+lua54.lua_sethook      .decl(c_void,             (lua54.lua_State_p, lua54.lua_Hook, ctypes.c_int, ctypes.c_int))
+lua54.lua_isyieldable  .decl(ctypes.c_int,       (lua54.lua_State_p,))
+lua54.lua_status       .decl(ctypes.c_int,       (lua54.lua_State_p,))
+lua54.lua_isinteger    .decl(ctypes.c_int,       (lua54.lua_State_p, ctypes.c_int))
+lua54.lua_rawset       .decl(c_void,             (lua54.lua_State_p, ctypes.c_int))
+lua54.lua_rawseti      .decl(c_void,             (lua54.lua_State_p, ctypes.c_int, ctypes.c_longlong))
+lua54.lua_checkstack   .decl(ctypes.c_int,       (lua54.lua_State_p, ctypes.c_int))
+lua54.lua_rawlen       .decl(ctypes.c_ulonglong, (lua54.lua_State_p, ctypes.c_int))
+lua54.lua_pushvalue    .decl(c_void,             (lua54.lua_State_p, ctypes.c_int))
+lua54.luaopen_debug    .decl(ctypes.c_int,       (lua54.lua_State_p,))
+lua54.luaopen_string   .decl(ctypes.c_int,       (lua54.lua_State_p,))
+lua54.luaopen_table    .decl(ctypes.c_int,       (lua54.lua_State_p,))
+lua54.lua_setmetatable .decl(ctypes.c_int,       (lua54.lua_State_p, ctypes.c_int))
+lua54.luaopen_coroutine.decl(ctypes.c_int,       (lua54.lua_State_p,))
+lua54.lua_getfield     .decl(ctypes.c_int,       (lua54.lua_State_p, ctypes.c_int, ctypes.c_char_p))
+lua54.lua_rotate       .decl(c_void,             (lua54.lua_State_p, ctypes.c_int, ctypes.c_int))
+lua54.lua_tointegerx   .decl(ctypes.c_longlong,  (lua54.lua_State_p, ctypes.c_int, ctypes.POINTER(ctypes.c_int)))
+
+# Python's raw allocator is thread safe and available everywhere, unlike finding the C library
+_mem_realloc = ctypes.pythonapi.PyMem_RawRealloc
+_mem_realloc.restype = ctypes.c_void_p
+_mem_realloc.argtypes = (ctypes.c_void_p, size_t)
+_mem_free = ctypes.pythonapi.PyMem_RawFree
+_mem_free.restype = None
+_mem_free.argtypes = (ctypes.c_void_p,)
+
+# lua_tolstring returning the raw pointer, for strings that may contain NUL bytes
+lua54.lua_tolstring_p = lua54.pylib["lua_tolstring"]
+lua54.lua_tolstring_p.restype = ctypes.c_void_p
+lua54.lua_tolstring_p.argtypes = (lua54.lua_State_p, ctypes.c_int, size_t_p)
+
+if hasattr(lua54.lib, "lua_closethread"):
+    lua54.lua_closethread.decl(ctypes.c_int, (lua54.lua_State_p, lua54.lua_State_p))
+else:
+    # Lua 5.4.0 - 5.4.5
+    lua54.lua_resetthread.decl(ctypes.c_int, (lua54.lua_State_p,))
+    def _lua_closethread(state, from_):
+        return lua54.lua_resetthread(state)
+    lua54.lua_closethread = _lua_closethread
 
 def _lua_pop(state, n):
     lua54.lua_settop(state, -n-1)
 lua54.lua_pop = _lua_pop
 
-import asyncio
+def _lua_remove(state, idx):
+    lua54.lua_rotate(state, idx, -1)
+    lua54.lua_pop(state, 1)
+lua54.lua_remove = _lua_remove
+
+def lua_upvalueindex(i):
+    return lua54.LUA_REGISTRYINDEX - i
 
 if __name__ == "__main__":
     # import faulthandler
@@ -628,7 +2804,7 @@ if __name__ == "__main__":
         tself[1][1] = -1
         tself[1][2] = -2
     
-    async def lua_print(runtime, *what):
+    def lua_print(runtime, *what):
         print("[lua]", *what)
 
     async def lua_wait(runtime, seconds):
@@ -645,13 +2821,12 @@ if __name__ == "__main__":
         return len(TASKS) - 1
     
     async def lua_join_task(runtime, i):
-        i = int(i)
         result = await TASKS[i]
         TASKS[i] = None
         return result
     
-    async def lua_is_task_done(runtime, i):
-        return TASKS[int(i)].done()
+    def lua_is_task_done(runtime, i):
+        return TASKS[i].done()
     
     async def main1():
         with open("example.lua", "r") as f:
@@ -659,11 +2834,11 @@ if __name__ == "__main__":
     
         rt = Runtime(program)
         
-        rt.register_command(lua_print, "print")
+        rt.register_command(lua_print, "print", sync=True)
         rt.register_command(lua_wait, "wait", 1)
         rt.register_command(lua_create_task, "create_task")
         rt.register_command(lua_join_task, "join_task", 1)
-        rt.register_command(lua_is_task_done, "is_task_done", 1)
+        rt.register_command(lua_is_task_done, "is_task_done", 1, sync=True)
         
         print("Function returned:", await rt.globals()["main"]())
         print("Done!")
@@ -674,11 +2849,11 @@ if __name__ == "__main__":
     
         rt = Runtime(program)
         
-        rt.register_command(lua_print, "print")
+        rt.register_command(lua_print, "print", sync=True)
         rt.register_command(lua_wait, "wait", 1)
         rt.register_command(lua_create_task, "create_task")
         rt.register_command(lua_join_task, "join_task", 1)
-        rt.register_command(lua_is_task_done, "is_task_done", 1)
+        rt.register_command(lua_is_task_done, "is_task_done", 1, sync=True)
         
         task = asyncio.create_task(rt.globals()["main"]())
         while 1:
@@ -696,11 +2871,80 @@ if __name__ == "__main__":
             program = f.read()
         
         rt = Runtime(program, filename="example.lua")
-        rt.register_command(lua_print, "print")
+        rt.register_command(lua_print, "print", sync=True)
         rt.register_command(lua_create_example_table, "create_example_table")
         await rt.globals()["table_init"]()
         print("Done!")
 
+    async def main4():
+        with open("example.lua", "r") as f:
+            program = f.read()
+
+        rt = Runtime(program, filename="example.lua")
+        rt.register_command(lua_print, "print", sync=True)
+        rt.register_command(lua_wait, "wait", 1)
+        rt.enable_scheduler()
+        await rt.globals()["scheduler_main"]()
+        print("Done!")
+
+    async def bench():
+        rt = Runtime("function echo(...) return ... end")
+        echo = rt.globals()["echo"]
+        data = {"list": list(range(1000)), "map": {str(i): i * 0.5 for i in range(1000)}}
+        busy = threading.Event()
+
+        def spin():
+            while busy.is_set():
+                pass
+
+        for contended in (False, True):
+            if contended:
+                # Every GIL release now hands the GIL to the spinning thread
+                busy.set()
+                threading.Thread(target=spin, daemon=True).start()
+            for mode in ("release", "auto"):
+                lua54.set_gil_mode(mode)
+                start = time.perf_counter()
+                for _ in range(5):
+                    Table.from_python(rt, data).to_python()
+                marshal_time = time.perf_counter() - start
+                start = time.perf_counter()
+                for i in range(500):
+                    await echo(i, "x", 1.5, None)
+                call_time = time.perf_counter() - start
+                print("%-8s %-14s 5 table round trips: %.3fs  500 calls: %.3fs" % (mode, "(busy thread)" if contended else "", marshal_time, call_time))
+        busy.clear()
+
+    async def check():
+        # Regressions, run with "check" as the only argument
+        src = """
+function alloc(n) local t = {} for i = 1, n do t[i] = i end return #t end
+function hog() setmetatable({}, {__gc = function() alloc(4000000) end}) end
+"""
+        rt = Runtime(src, memory_limit=2 * 1024 * 1024)
+        alloc = rt.globals()["alloc"]
+        try:
+            await alloc(10**7)
+            raise AssertionError("memory limit not enforced")
+        except MemoryError:
+            pass
+        # The failed call's thread must not keep the runaway table alive
+        for _ in range(3):
+            assert await alloc(1000) == (1000,)
+        await rt.globals()["hog"]()
+        rt.gc_collect()
+        assert rt.memory_stats()["peak"] <= rt.memory_limit, "finalizer ran past the memory limit"
+
+        rt = Runtime("function s() return pcall(tasks.select) end function t() return tasks.join(tasks.spawn(s)) end")
+        rt.enable_scheduler()
+        assert await rt.globals()["s"]() == (False, "select needs at least one task")
+        assert await rt.globals()["t"]() == (False, "select needs at least one task")
+        assert not rt.scheduler.tasks
+
+        data = {"list": [1, [2, 3]], "map": {"a": 1}, "empty": {}}
+        assert Table.from_python(rt, data).to_python() == data
+        print("Checks passed")
+
     async def main():
         print("Example 1")
         await main1()
@@ -712,5 +2956,8 @@ if __name__ == "__main__":
         await asyncio.sleep(2)
         print("Example 3")
         await main3()
+        print("==============================")
+        print("Example 4")
+        await main4()
     
-    asyncio.run(main())
+    asyncio.run({"bench": bench, "check": check}.get(sys.argv[1] if len(sys.argv) == 2 else None, main)())
@@ -38,4 +38,20 @@ function task(first_delay, delays, text)
         wait(delays)
     end
     return "done"
-end
\ No newline at end of file
+end
+function scheduler_main()
+    local t1 = tasks.spawn(task, 0, 1, "[task 1] hello")
+    local t2 = tasks.spawn(scheduled_task, 0.25, 0.5, "[task 2] hello")
+    print("First finished: " .. tostring(tasks.select(t1, t2) == t2 and "task 2" or "task 1"))
+    print("Task 1 returned " .. tostring(tasks.join(t1)))
+    print("Task 2 returned " .. tostring(tasks.join(t2)))
+end
+
+function scheduled_task(first_delay, delays, text)
+    tasks.sleep(first_delay)
+    for var=0,4 do
+        print(text)
+        tasks.sleep(delays)
+    end
+    return "done"
+end